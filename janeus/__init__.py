@@ -1,54 +1,501 @@
 """janeus implements LDAP-related functionality for sites of the Jonge Democraten.
 """
 
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from django.conf import settings
+from django.utils.module_loading import import_string
 import ldap
-from ldap.filter import filter_format
-from janeus.ldappool import LDAPPool
+from ldap.controls import SimplePagedResultsControl
+from ldap.dn import escape_dn_chars, str2dn
+from ldap.filter import escape_filter_chars, filter_format
+from janeus.cache import JaneusCache, SingleFlight
+from janeus.entry import JaneusEntry, _text, dn_key, entry
+from janeus.ldappool import RETIRE_ERRORS, LDAPAuthPool, LDAPPool, reset_after_fork
+from janeus.servers import ServerRouter
+from janeus.groupindex import GroupIndex
+from janeus.latency import LatencyTracker
+from janeus import groupindex, poolstats, throttle, tracing
+from janeus.utils import request_memo
+
+default_app_config = 'janeus.apps.JaneusConfig'
+
+# seconds between checks for the answer of a hedged search, doubled after every check up to the maximum;
+# libldap may buffer results (e.g. with TLS), so never wait longer than the maximum for the sockets
+HEDGE_POLL_INTERVAL = 0.002
+HEDGE_MAX_POLL_INTERVAL = 0.05
+
+
+def post_fork(server=None, worker=None):
+    """Empties the LDAP pools after a fork and opens new connections.
+    Can be used as the post_fork hook of gunicorn.
+    """
+    reset_after_fork()
+    Janeus().warm_up()
 
 
 class Janeus(object):
+    # attributes per methode, aan te passen met JANEUS_ATTRIBUTES
+    ATTRIBUTES = {
+        'by_dn': ['*'],
+        'by_uid': ['*', 'memberOf'],
+        'by_email': ['*'],
+        'members_of_group': ['cn', 'uid', 'sn', 'mail'],
+        'groups_of_dn': ['cn'],
+    }
+
+    # maximale tijd in seconden per soort zoekopdracht, aan te passen met JANEUS_TIMEOUTS
+    TIMEOUTS = {
+        'by_dn': 1,
+        'by_uid': 1,
+        'by_email': 1,
+        'groups_of_dn': 3,
+        'members_of_group': 10,
+        'batch': 10,
+    }
+
+    @classmethod
+    def _timeout(cls, operation):
+        """Geeft de timeout van operation; met JANEUS_ADAPTIVE_TIMEOUTS korter als LDAP snel antwoordt"""
+        timeout = getattr(settings, 'JANEUS_TIMEOUTS', {}).get(operation, cls.TIMEOUTS.get(operation, 10))
+        if getattr(settings, 'JANEUS_ADAPTIVE_TIMEOUTS', False):
+            p99 = LatencyTracker().percentile(operation, 99)
+            if p99 is not None:
+                adaptive = p99 * getattr(settings, 'JANEUS_ADAPTIVE_TIMEOUT_FACTOR', 3)
+                timeout = min(timeout, max(adaptive, getattr(settings, 'JANEUS_ADAPTIVE_TIMEOUT_MIN', 0.2)))
+        return timeout
+
+    @staticmethod
+    def _hedge_delay(operation):
+        """Geeft na hoeveel seconden een zoekopdracht ook op een tweede verbinding start, of None"""
+        if not getattr(settings, 'JANEUS_HEDGE', False):
+            return None
+        delay = getattr(settings, 'JANEUS_HEDGE_DELAY', None)
+        if delay is None:
+            delay = LatencyTracker().percentile(operation, 95)
+        return delay
+
+    @classmethod
+    def _attributes(cls, method, *required):
+        """Geeft de attributen die method opvraagt, aangevuld met required"""
+        attrlist = list(getattr(settings, 'JANEUS_ATTRIBUTES', {}).get(method, cls.ATTRIBUTES[method]))
+        if '*' not in attrlist:
+            attrlist.extend(attr for attr in required if attr not in attrlist)
+        return attrlist
+
+    @staticmethod
+    def _metrics():
+        metrics = getattr(settings, 'JANEUS_POOL_METRICS', None)
+        return import_string(metrics) if isinstance(metrics, str) else metrics
+
+    def _pool(self):
+        return LDAPPool(
+            getattr(settings, 'JANEUS_POOL_MAX_SIZE', 8),
+            idle_probe=getattr(settings, 'JANEUS_POOL_IDLE_PROBE', 30),
+            max_age=getattr(settings, 'JANEUS_POOL_MAX_AGE', 3600),
+            min_idle=getattr(settings, 'JANEUS_POOL_MIN_IDLE', 0),
+            keepalive=getattr(settings, 'JANEUS_POOL_KEEPALIVE', None),
+            metrics=self._metrics())
+
+    @contextmanager
+    def _connection(self, uri=None):
+        if uri is None:
+            uri = ServerRouter().read_servers()[0]
+        with self._pool().connection(uri, settings.JANEUS_DN, settings.JANEUS_PASS) as conn:
+            yield conn
+        poolstats.publish()
+
+    def _auth_pool(self):
+        return LDAPAuthPool(
+            getattr(settings, 'JANEUS_AUTH_POOL_SIZE', 4),
+            max_age=getattr(settings, 'JANEUS_POOL_MAX_AGE', 3600),
+            metrics=self._metrics())
+
+    def pool_stats(self):
+        """Geeft de statistieken van de pools van dit proces, {'search': [...], 'auth': [...]}"""
+        return {'search': self._pool().stats(), 'auth': self._auth_pool().stats()}
+
+    def warm_up(self):
+        """Opent alvast verbindingen, JANEUS_POOL_MIN_IDLE (minstens één) per server en voor wachtwoorden"""
+        count = max(1, getattr(settings, 'JANEUS_POOL_MIN_IDLE', 0))
+        try:
+            for uri in ServerRouter().read_servers():
+                self._pool().warm_up(uri, settings.JANEUS_DN, settings.JANEUS_PASS, count)
+            self._auth_pool().warm_up(ServerRouter().primary(), settings.JANEUS_DN, settings.JANEUS_PASS, count)
+        except ldap.LDAPError:
+            # de verbindingen worden dan bij het eerste gebruik geopend
+            pass
+
     @contextmanager
-    def _connection(self):
-        with LDAPPool().connection(settings.JANEUS_SERVER, settings.JANEUS_DN, settings.JANEUS_PASS) as conn:
+    def _bind(self, dn, password):
+        pool = self._auth_pool()
+        # wachtwoorden altijd bij de primary controleren
+        with pool.bind(ServerRouter().primary(), settings.JANEUS_DN, settings.JANEUS_PASS, dn, password) as conn:
             yield conn
+        poolstats.publish()
+
+    def _search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, timeout=None, operation=None):
+        if timeout is None:
+            timeout = self._timeout(operation)
+        delay = self._hedge_delay(operation)
+        router = ServerRouter()
+        servers = router.read_servers()
+        single = len(servers) == 1
+        if single:
+            # pooled connections are not checked before use, so try once more with a new connection
+            servers = servers * 2
+        for i, uri in enumerate(servers):
+            start = time.time()
+            try:
+                with tracing.span(operation or 'search', uri, base, filterstr) as span:
+                    if delay is not None and delay < timeout:
+                        # hedge bij de volgende server, of bij dezelfde als er maar één is
+                        hedge_uri = servers[(i + 1) % len(servers)]
+                        result_data = self._hedged_search(uri, hedge_uri, delay, base, scope, filterstr, attrlist, timeout)
+                    else:
+                        with self._connection(uri) as l:
+                            result_data = l.search_st(base, scope, filterstr, attrlist, timeout=timeout)
+                    span.count = len(result_data)
+            except RETIRE_ERRORS as e:
+                router.record(uri, failed=True)
+                if isinstance(e, ldap.TIMEOUT):
+                    # zodat de adaptieve timeout niet steeds korter wordt
+                    LatencyTracker().record(operation, time.time() - start)
+                if i == len(servers) - 1 or (single and not isinstance(e, ldap.SERVER_DOWN)):
+                    raise
+                continue
+            duration = time.time() - start
+            router.record(uri, duration)
+            LatencyTracker().record(operation, duration)
+            return result_data
+
+    def _hedged_search(self, uri, hedge_uri, delay, base, scope, filterstr, attrlist, timeout):
+        """Zoekt bij uri, en na delay seconden zonder antwoord ook bij hedge_uri als daar een verbinding vrij is.
+        Geeft het eerste antwoord en breekt de andere zoekopdracht af.
+        Als de verbinding met hedge_uri faalt, telt dat voor hedge_uri en wordt verder op uri gewacht.
+        """
+        deadline = time.time() + timeout
+        with self._connection(uri) as l:
+            msgid = l.search_ext(base, scope, filterstr, attrlist, timeout=timeout)
+            try:
+                rtype, rdata, rmsgid, rctrls = l.result3(msgid, timeout=delay)
+                # met delay 0 geeft result3 (None, None, None, None) in plaats van TIMEOUT
+                if rtype is not None:
+                    return rdata
+            except ldap.TIMEOUT:
+                pass
+
+            error = None
+            try:
+                with self._pool().connection(hedge_uri, settings.JANEUS_DN, settings.JANEUS_PASS, block=False) as l2:
+                    if l2 is not None:
+                        msgid2 = l2.search_ext(base, scope, filterstr, attrlist, timeout=timeout)
+                        winner = None
+                        interval = HEDGE_POLL_INTERVAL
+                        try:
+                            while True:
+                                try:
+                                    rtype, rdata, rmsgid, rctrls = l.result3(msgid, timeout=0)
+                                except ldap.LDAPError as e:
+                                    # pas buiten deze with gooien, anders haalt de pool de tweede verbinding weg
+                                    error = e
+                                    break
+                                if rtype is not None:
+                                    winner = l
+                                    break
+                                rtype, rdata, rmsgid, rctrls = l2.result3(msgid2, timeout=0)
+                                if rtype is not None:
+                                    winner = l2
+                                    break
+                                remaining = deadline - time.time()
+                                if remaining <= 0:
+                                    break
+                                self._wait_readable((l, l2), min(remaining, interval))
+                                interval = min(interval * 2, HEDGE_MAX_POLL_INTERVAL)
+                        finally:
+                            if winner is l2:
+                                self._abandon(l, msgid)
+                            else:
+                                self._abandon(l2, msgid2)
+                        if winner is not None:
+                            return rdata
+            except RETIRE_ERRORS:
+                ServerRouter().record(hedge_uri, failed=True)
+            if error is not None:
+                raise error
+            # geen tweede verbinding, de tweede faalde of de tijd is om: wachten op de eerste
+            return l.result3(msgid, timeout=max(deadline - time.time(), 0.001))[1]
+
+    @staticmethod
+    def _wait_readable(conns, timeout):
+        """Wacht tot een van de sockets van conns leesbaar is, of timeout seconden als de sockets niet bekend zijn"""
+        fds = []
+        for conn in conns:
+            try:
+                fd = conn.get_option(ldap.OPT_DESC)
+            except (AttributeError, ldap.LDAPError):
+                fd = None
+            if fd is None or fd < 0:
+                time.sleep(timeout)
+                return
+            fds.append(fd)
+        select.select(fds, [], [], timeout)
+
+    @staticmethod
+    def _abandon(conn, msgid):
+        try:
+            conn.abandon(msgid)
+        except ldap.LDAPError:
+            # de verbinding faalt bij het volgende gebruik
+            pass
+
+    def _paged_search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, timeout=None, operation=None):
+        """Zoekt met Simple Paged Results (RFC 2696) en geeft de entries zodra een pagina binnen is"""
+        if timeout is None:
+            timeout = self._timeout(operation)
+        control = SimplePagedResultsControl(True, size=getattr(settings, 'JANEUS_PAGE_SIZE', 500), cookie='')
+        router = ServerRouter()
+        servers = router.read_servers()
+        single = len(servers) == 1
+        if single:
+            # pooled connections are not checked before use, so try once more with a new connection
+            servers = servers * 2
+        for i, uri in enumerate(servers):
+            start = time.time()
+            first = True
+            try:
+                # de cookie hoort bij de verbinding, dus alle pagina's gebruiken dezelfde verbinding
+                with self._connection(uri) as l:
+                    while True:
+                        with tracing.span(operation or 'paged_search', uri, base, filterstr) as span:
+                            msgid = l.search_ext(base, scope, filterstr, attrlist, serverctrls=[control], timeout=timeout)
+                            rtype, rdata, rmsgid, rctrls = l.result3(msgid, timeout=timeout)
+                            span.count = len(rdata)
+                        if first:
+                            duration = time.time() - start
+                            router.record(uri, duration)
+                            LatencyTracker().record(operation, duration)
+                            first = False
+                        for dn, attrs in rdata:
+                            yield JaneusEntry(dn, attrs)
+                        cookies = [c.cookie for c in rctrls if c.controlType == SimplePagedResultsControl.controlType]
+                        if not cookies or not cookies[0]:
+                            return
+                        control.cookie = cookies[0]
+            except RETIRE_ERRORS as e:
+                if not first:
+                    # er zijn al entries gegeven, dus niet opnieuw beginnen bij een andere server
+                    raise
+                router.record(uri, failed=True)
+                if isinstance(e, ldap.TIMEOUT):
+                    LatencyTracker().record(operation, time.time() - start)
+                if i == len(servers) - 1 or (single and not isinstance(e, ldap.SERVER_DOWN)):
+                    raise
+
+    @staticmethod
+    def _batch(keys, search, workers=None):
+        """Voert search uit voor stukken van keys, parallel over meerdere verbindingen"""
+        size = getattr(settings, 'JANEUS_BATCH_SIZE', 100)
+        chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+        if workers is None:
+            workers = getattr(settings, 'JANEUS_BATCH_WORKERS', 4)
+        workers = min(len(chunks), workers)
+        if workers <= 1:
+            return [entry for chunk in chunks for entry in search(chunk)]
+        with ThreadPoolExecutor(workers) as executor:
+            return [entry for entries in executor.map(search, chunks) for entry in entries]
+
+    @staticmethod
+    def _mirror():
+        """Geeft janeus.mirror als JANEUS_MIRROR aan staat, anders None"""
+        if not getattr(settings, 'JANEUS_MIRROR', False):
+            return None
+        from janeus import mirror
+        return mirror
+
+    @staticmethod
+    def _group_index():
+        """Geeft de GroupIndex als JANEUS_GROUP_INDEX aan staat en de index bruikbaar is, anders None"""
+        if not groupindex.enabled():
+            return None
+        index = GroupIndex()
+        return index if index.refresh() else None
+
+    @staticmethod
+    def _nested(nested):
+        if nested is None:
+            return getattr(settings, 'JANEUS_NESTED_GROUPS', False)
+        return nested
+
+    @staticmethod
+    def _cached(kind, key, fetch):
+        """Geeft het resultaat van fetch uit het geheugen van het request, de cache of LDAP"""
+        memo = request_memo()
+        memo_key = JaneusCache._key(kind, key)
+        if memo is not None and memo_key in memo:
+            return memo[memo_key]
+
+        cache = JaneusCache()
+        hit = False
+        if cache.enabled():
+            hit, value = cache.get(kind, key)
+        if not hit:
+            if getattr(settings, 'JANEUS_SINGLE_FLIGHT', True):
+                # gelijktijdige dezelfde zoekopdrachten delen één zoekopdracht
+                value = SingleFlight().do(memo_key, fetch)
+            else:
+                value = fetch()
+            if cache.enabled():
+                cache.set(kind, key, value)
+
+        if memo is not None:
+            memo[memo_key] = value
+        return value
+
+    @staticmethod
+    def _cached_many(kind, keys, fetch):
+        """Zoals _cached, maar fetch(keys) geeft een dict met een waarde voor alle keys"""
+        keys = list(set(keys))
+        cache = JaneusCache()
+        if not cache.enabled():
+            return fetch(keys)
+        result = {}
+        missing = []
+        for key in keys:
+            hit, value = cache.get(kind, key)
+            if hit:
+                result[key] = value
+            else:
+                missing.append(key)
+        if missing:
+            fetched = fetch(missing)
+            for key in missing:
+                cache.set(kind, key, fetched[key])
+            result.update(fetched)
+        return result
+
+    def invalidate(self, uid=None, dn=None, email=None):
+        """Verwijdert gecachte gegevens van gebruiker met uid, dn en/of email"""
+        memo = request_memo()
+        if memo is not None:
+            memo.clear()
+        cache = JaneusCache()
+        if uid is not None:
+            hit, res = cache.get('uid', uid)
+            if dn is None and hit and res is not None:
+                dn = res[0]
+            cache.delete('uid', uid)
+        if dn is not None:
+            cache.delete('dn', dn)
+            cache.delete('groups', dn)
+            cache.delete('nested_groups', dn)
+        if email is not None:
+            cache.delete('email', email)
 
     def by_dn(self, dn):
         """Opvragen (dn, attrs) van gebruiker met dn, of geeft None terug als niet gevonden"""
-        with self._connection() as l:
+        mirror = self._mirror()
+        if mirror is not None:
+            return mirror.by_dn(dn)
+
+        def fetch():
             try:
-                result_data = l.search_st(dn, ldap.SCOPE_BASE, timeout=1)
+                result_data = self._search(dn, ldap.SCOPE_BASE, attrlist=self._attributes('by_dn'), operation='by_dn')
             except ldap.NO_SUCH_OBJECT:
                 return None
-        if len(result_data) != 1:
-            return None
-        dn, attrs = result_data[0]
-        return dn, attrs
+            if len(result_data) != 1:
+                return None
+            return entry(result_data[0])
+        return self._cached('dn', dn, fetch)
 
     def by_uid(self, uid):
         """Opvragen (dn, attrs) van gebruiker met uid, of geeft None terug als niet uniek gevonden"""
-        baseDN = "ou=users,dc=jd,dc=nl"
-        searchFilter = filter_format('(uid=%s)', (str(uid),))
-        with self._connection() as l:
-            result_data = l.search_st(baseDN, ldap.SCOPE_ONELEVEL, searchFilter, timeout=1)
-        if len(result_data) != 1:
-            return None
-        dn, attrs = result_data[0]
-        return dn, attrs
+        mirror = self._mirror()
+        if mirror is not None:
+            return mirror.by_uid(uid)
+
+        def fetch():
+            baseDN = "ou=users,dc=jd,dc=nl"
+            searchFilter = filter_format('(uid=%s)', (str(uid),))
+            # memberOf is operational and only returned when asked for
+            result_data = self._search(baseDN, ldap.SCOPE_ONELEVEL, searchFilter, self._attributes('by_uid'), operation='by_uid')
+            if len(result_data) != 1:
+                return None
+            return entry(result_data[0])
+        return self._cached('uid', uid, fetch)
+
+    def by_uids(self, uids, workers=None):
+        """Opvragen (dn, attrs) van gebruikers met uids.
+        Geeft een dict uid -> (dn, attrs), of uid -> None als de uid niet uniek gevonden is
+        """
+        def search(chunk):
+            searchFilter = '(|{})'.format(''.join(filter_format('(uid=%s)', (str(uid),)) for uid in chunk))
+            return self._search("ou=users,dc=jd,dc=nl", ldap.SCOPE_ONELEVEL, searchFilter,
+                                self._attributes('by_uid', 'uid'), operation='batch')
+
+        def fetch(keys):
+            found = {}
+            for dn, attrs in self._batch(keys, search, workers):
+                for value in attrs.get('uid', []):
+                    found.setdefault(_text(value).lower(), []).append((dn, attrs))
+            result = {}
+            for uid in keys:
+                entries = found.get(str(uid).lower(), [])
+                result[uid] = entry(entries[0]) if len(entries) == 1 else None
+            return result
+        return self._cached_many('uid', uids, fetch)
 
     def by_lidnummer(self, lidnummer):
         """Opvragen (dn, attrs) van gebruiker met lidnummer, of geeft None terug als niet uniek gevonden"""
         dn = "cn=" + str(int(lidnummer)) + ",ou=users,dc=jd,dc=nl"
         return self.by_dn(dn)
 
+    def by_lidnummers(self, lidnummers, workers=None):
+        """Opvragen (dn, attrs) van gebruikers met lidnummers.
+        Geeft een dict lidnummer -> (dn, attrs), of lidnummer -> None als het lidnummer niet gevonden is
+        """
+        dns = dict(("cn=" + str(int(lidnummer)) + ",ou=users,dc=jd,dc=nl", lidnummer) for lidnummer in lidnummers)
+        return dict((dns[dn], res) for dn, res in self.by_dns(list(dns), workers).items())
+
+    def by_dns(self, dns, workers=None):
+        """Opvragen (dn, attrs) van gebruikers in ou=users met dns.
+        Geeft een dict dn -> (dn, attrs), of dn -> None als de dn niet gevonden is
+        """
+        mirror = self._mirror()
+        if mirror is not None:
+            return dict((dn, mirror.by_dn(dn)) for dn in dns)
+
+        def search(chunk):
+            rdns = []
+            for dn in chunk:
+                attr, value, flags = str2dn(dn)[0][0]
+                rdns.append('({}={})'.format(attr, escape_filter_chars(value)))
+            searchFilter = '(|{})'.format(''.join(rdns))
+            return self._search("ou=users,dc=jd,dc=nl", ldap.SCOPE_ONELEVEL, searchFilter,
+                                self._attributes('by_dn'), operation='batch')
+
+        def fetch(keys):
+            found = dict((dn_key(dn), JaneusEntry(dn, attrs)) for dn, attrs in self._batch(keys, search, workers))
+            return dict((dn, found.get(dn_key(dn))) for dn in keys)
+        return self._cached_many('dn', dns, fetch)
+
     def by_email(self, email):
         """Opvragen list van pairs (dn, attrs) van gebruikers met email"""
+        mirror = self._mirror()
+        if mirror is not None:
+            return mirror.by_email(email)
+        return self._cached('email', email, lambda: list(self.iter_by_email(email)))
+
+    def iter_by_email(self, email):
+        """Zoals by_email, maar geeft de pairs (dn, attrs) per pagina"""
+        mirror = self._mirror()
+        if mirror is not None:
+            return iter(mirror.by_email(email))
         baseDN = "ou=users,dc=jd,dc=nl"
         searchFilter = filter_format('(mail=%s)', (str(email),))
-        with self._connection() as l:
-            result_data = list(l.search_st(baseDN, ldap.SCOPE_ONELEVEL, searchFilter, timeout=1))
-        return result_data
+        return self._paged_search(baseDN, ldap.SCOPE_ONELEVEL, searchFilter, self._attributes('by_email'), operation='by_email')
 
     def attributes(self, lidnummer):
         """Vraag emailadres en naam van lid met lidnummer op.
@@ -69,28 +516,157 @@ class Janeus(object):
         """
         return [(int(attrs['cn'][0]), attrs['sn'][0]) for dn, attrs in self.by_email(email)]
 
-    def groups_of_dn(self, dn):
-        """Geeft alle groepen (dn) waarvan de gebruiker lid is"""
-        baseDN = "ou=groups,dc=jd,dc=nl"
-        searchFilter = filter_format('(&(objectClass=groupOfNames)(member=%s))', (str(dn),))
-        with self._connection() as l:
-            result_data = list(l.search_st(baseDN, ldap.SCOPE_SUBTREE, searchFilter, timeout=3))
-        return [attrs['cn'][0] for dn2, attrs in result_data]
+    def groups_of_dn(self, dn, nested=None):
+        """Geeft alle groepen (dn) waarvan de gebruiker lid is.
+        Met nested ook de groepen waarvan die groepen lid zijn (standaard JANEUS_NESTED_GROUPS)
+        """
+        nested = self._nested(nested)
+        mirror = self._mirror()
+        if mirror is not None and not nested:
+            return mirror.groups_of_dn(dn)
+        index = self._group_index()
+        if index is not None:
+            groups = index.groups_of(dn, nested)
+            if groups is not None:
+                return groups
+
+        def fetch():
+            baseDN = "ou=groups,dc=jd,dc=nl"
+            attrlist = self._attributes('groups_of_dn', 'cn')
+            groups = []
+            seen = set()
+            todo = [dn]
+            while todo:
+                searchFilter = filter_format('(&(objectClass=groupOfNames)(member=%s))', (str(todo.pop()),))
+                for dn2, attrs in self._search(baseDN, ldap.SCOPE_SUBTREE, searchFilter, attrlist, operation='groups_of_dn'):
+                    if dn2.lower() not in seen:
+                        seen.add(dn2.lower())
+                        groups.append(attrs['cn'][0])
+                        if nested:
+                            todo.append(dn2)
+            return groups
+        return self._cached('nested_groups' if nested else 'groups', dn, fetch)
+
+    def groups_of_dns(self, dns, workers=None, nested=None):
+        """Geeft een dict dn -> alle groepen waarvan de gebruiker met dn lid is"""
+        nested = self._nested(nested)
+        if nested or self._group_index() is not None:
+            return dict((dn, self.groups_of_dn(dn, nested)) for dn in set(dns))
 
-    def members_of_group(self, group):
-        """Geeft alle leden (dn,attrs) die lid zijn van de groep"""
+        def search(chunk):
+            members = ''.join(filter_format('(member=%s)', (str(dn),)) for dn in chunk)
+            searchFilter = '(&(objectClass=groupOfNames)(|{}))'.format(members)
+            return self._search("ou=groups,dc=jd,dc=nl", ldap.SCOPE_SUBTREE, searchFilter, ['cn', 'member'], operation='batch')
+
+        def fetch(keys):
+            # member values can be written differently than the keys, e.g. with spaces after the commas
+            wanted = {}
+            for dn in keys:
+                wanted.setdefault(dn_key(dn), []).append(dn)
+            result = dict((dn, []) for dn in keys)
+            for dn2, attrs in self._batch(keys, search, workers):
+                for member in attrs.get('member', []):
+                    for dn in wanted.get(dn_key(member), []):
+                        result[dn].append(attrs['cn'][0])
+            return result
+        return self._cached_many('groups', dns, fetch)
+
+    @staticmethod
+    def _memberof_groups(attrs):
+        """Geeft de groepen uit memberOf, of None als memberOf niet gebruikt kan worden"""
+        if not getattr(settings, 'JANEUS_USE_MEMBEROF', True) or 'memberOf' not in attrs:
+            return None
+        if getattr(settings, 'JANEUS_NESTED_GROUPS', False):
+            # memberOf bevat alleen de directe groepen
+            return None
+        groups = []
+        for value in attrs['memberOf']:
+            text = _text(value)
+            # de waarde kan anders geschreven zijn, bijvoorbeeld met spaties na de komma's
+            if not dn_key(text).endswith(',ou=groups,dc=jd,dc=nl'):
+                continue
+            attr, cn, flags = str2dn(text)[0][0]
+            if attr.lower() == 'cn':
+                # zelfde type als de cn van groups_of_dn
+                groups.append(cn.encode('utf-8') if isinstance(value, bytes) else cn)
+        return groups
+
+    def groups_of_entry(self, dn, attrs):
+        """Geeft alle groepen waarvan de gebruiker (dn, attrs) lid is, uit memberOf indien aanwezig"""
+        groups = self._memberof_groups(attrs)
+        if groups is None:
+            return self.groups_of_dn(dn)
+        return groups
+
+    def members_of_group(self, group, nested=False):
+        """Geeft alle leden (dn,attrs) die lid zijn van de groep.
+        Met nested ook de leden van groepen die lid zijn van de groep
+        """
+        return list(self.iter_members_of_group(group, nested))
+
+    def iter_members_of_group(self, group, nested=False):
+        """Zoals members_of_group, maar geeft de leden (dn,attrs) per pagina.
+        De verbinding blijft in gebruik tot de generator is uitgeput of gesloten.
+        """
+        if nested:
+            dns = self._nested_members("cn={},ou=groups,dc=jd,dc=nl".format(escape_dn_chars(str(group))))
+            return iter(res for dn, res in sorted(self.by_dns(dns).items()) if res is not None)
+        mirror = self._mirror()
+        if mirror is not None:
+            return iter(mirror.members_of_group(group))
         baseDN = "ou=users,dc=jd,dc=nl"
         searchFilter = filter_format('(&(objectClass=inetOrgPerson)(memberOf=cn=%s,ou=groups,dc=jd,dc=nl))', (str(group),))
-        with self._connection() as l:
-            result_data = list(l.search_st(baseDN, ldap.SCOPE_SUBTREE, searchFilter, timeout=10))
-        return result_data
+        return self._paged_search(baseDN, ldap.SCOPE_SUBTREE, searchFilter, self._attributes('members_of_group'), operation='members_of_group')
+
+    def _nested_members(self, group_dn):
+        """Geeft de dns van de leden van de groep en van de groepen daarin, zonder de groepen zelf"""
+        index = self._group_index()
+        if index is not None:
+            dns = index.members_of(group_dn, nested=True)
+            if dns is not None:
+                return dns
+        result, seen, todo = set(), set(), [group_dn]
+        while todo:
+            group_dn = todo.pop()
+            if group_dn.lower() in seen:
+                continue
+            seen.add(group_dn.lower())
+            try:
+                result_data = self._search(group_dn, ldap.SCOPE_BASE, '(objectClass=groupOfNames)', ['member'], operation='groups_of_dn')
+            except ldap.NO_SUCH_OBJECT:
+                continue
+            for dn2, attrs in result_data:
+                for member in attrs.get('member', []):
+                    member = _text(member)
+                    if member.lower().endswith(',ou=groups,dc=jd,dc=nl'):
+                        todo.append(member)
+                    elif member:
+                        result.add(member)
+        return sorted(result)
+
+    def login(self, uid, password):
+        """Probeert in te loggen met uid+password, geeft (dn, attrs, groups) of None indien mislukt.
+        Kost één zoekopdracht (met memberOf) en één bind; een onbekende uid wordt onthouden met JANEUS_THROTTLE.
+        """
+        if throttle.is_unknown(uid):
+            return None
+        res = self.by_uid(uid)
+        if res is None:
+            throttle.record_unknown(uid)
+            return None
+        dn, attrs = res
+        if not self.test_login(dn, password):
+            return None
+        return dn, attrs, self.groups_of_entry(dn, attrs)
 
     def test_login(self, dn, password):
         """Probeert in te loggen met dn+password, True/False indien gelukt/mislukt"""
+        if not password:
+            # een bind zonder wachtwoord is een anonieme bind, die altijd lukt
+            return False
         try:
-            testconn = ldap.initialize(settings.JANEUS_SERVER)
-            testconn.simple_bind_s(dn, password)
-            return True
+            with self._bind(dn, password):
+                return True
         except ldap.INVALID_CREDENTIALS:
             return False
 
@@ -98,8 +674,7 @@ class Janeus(object):
         """Verander wachtwoord voor gebruiker uid van old naar new"""
         try:
             dn, attrs = self.by_uid(uid)
-            conn = ldap.initialize(settings.JANEUS_SERVER)
-            conn.simple_bind_s(dn, old)
-            return conn.passwd_s(dn, old, new)
+            with self._bind(dn, old) as conn:
+                return conn.passwd_s(dn, old, new)
         except ldap.INVALID_CREDENTIALS:
             return None
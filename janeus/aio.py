@@ -0,0 +1,299 @@
+"""Asyncio counterpart of Janeus, for ASGI deployments.
+
+The LDAP operations use the asynchronous (message id) API of python-ldap, so
+waiting for LDAP does not block the event loop.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import ldap
+from ldap.filter import filter_format
+from janeus import Janeus, throttle
+from janeus.cache import JaneusCache
+from janeus.entry import JaneusEntry, entry
+from janeus.latency import LatencyTracker
+from janeus.ldappool import RETIRE_ERRORS, initialize
+from janeus.servers import ServerRouter
+
+# libldap may buffer results (e.g. with TLS), so never wait longer than this for the socket
+POLL_INTERVAL = 0.05
+
+
+async def blocking(func, *args):
+    """Runs the blocking function func, e.g. a call to a Django cache, in a thread"""
+    return await sync_to_async(func, thread_sensitive=False)(*args)
+
+
+async def _readable(conn, timeout):
+    """Waits until the socket of conn is readable or timeout seconds have passed"""
+    loop = asyncio.get_event_loop()
+    try:
+        fd = conn.get_option(ldap.OPT_DESC)
+    except (AttributeError, ldap.LDAPError):
+        fd = None
+    if fd is None or fd < 0:
+        await asyncio.sleep(timeout)
+        return
+
+    future = loop.create_future()
+    loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await asyncio.wait([future], timeout=timeout)
+    finally:
+        loop.remove_reader(fd)
+
+
+async def result(conn, msgid, timeout):
+    """Waits for the complete result of operation msgid, returns (rtype, rdata, rctrls)"""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        rtype, rdata, rmsgid, rctrls = conn.result3(msgid, all=1, timeout=0)
+        if rtype is not None:
+            return rtype, rdata, rctrls
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            conn.abandon(msgid)
+            raise ldap.TIMEOUT()
+        await _readable(conn, min(remaining, POLL_INTERVAL))
+
+
+class AsyncLDAPPool(object):
+    """Asyncio version of LDAPPool, to be used from a single event loop"""
+    __shared_state = {}
+
+    def __init__(self, connection_limit=8):
+        self.__dict__ = self.__shared_state
+        self._setup(connection_limit)
+
+    def _setup(self, connection_limit):
+        if 'connections' not in self.__dict__:
+            self.connections = {}
+
+        if 'connection_limit' not in self.__dict__:
+            self.connection_limit = connection_limit
+
+    async def _create_connection(self, uri, dn, password):
+        conn = initialize(uri)
+        await result(conn, conn.simple_bind(dn, password), 10)
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.unbind_ext()
+        except ldap.LDAPError:
+            pass
+
+    async def _acquire(self, uri, dn, password):
+        if (uri, dn) not in self.connections:
+            self.connections[uri, dn] = asyncio.Condition(), [0], []
+        slot = self.connections[uri, dn]
+        lock, counter, connections = slot
+
+        async with lock:
+            while not connections and counter[0] >= self.connection_limit:
+                await lock.wait()
+            if connections:
+                return slot, connections.pop()
+            # reserve a place for a new connection
+            counter[0] += 1
+
+        try:
+            return slot, await self._create_connection(uri, dn, password)
+        except BaseException:
+            await self._release(slot, None)
+            raise
+
+    @staticmethod
+    async def _release(slot, conn):
+        lock, counter, connections = slot
+        async with lock:
+            if conn is not None:
+                connections.append(conn)
+            else:
+                counter[0] -= 1
+            lock.notify()
+
+    @asynccontextmanager
+    async def connection(self, uri, dn, password):
+        slot, conn = await self._acquire(uri, dn, password)
+        try:
+            yield conn
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT, asyncio.CancelledError):
+            # connection is lost or has an operation in progress
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            await self._release(slot, conn)
+
+
+class AsyncLDAPAuthPool(AsyncLDAPPool):
+    """Asyncio version of LDAPAuthPool, so password checks do not take the connections of searches"""
+    __shared_state = {}
+
+    def __init__(self, connection_limit=4):
+        self.__dict__ = self.__shared_state
+        self._setup(connection_limit)
+
+    def connection(self, uri, dn, password):
+        raise TypeError('connections of AsyncLDAPAuthPool are bound as users, use bind()')
+
+    @asynccontextmanager
+    async def bind(self, uri, dn, password, user_dn, user_password):
+        """Yields a connection bound as user_dn, raises ldap.INVALID_CREDENTIALS if that fails"""
+        slot, conn = await self._acquire(uri, dn, password)
+        try:
+            try:
+                await result(conn, conn.simple_bind(user_dn, user_password), 10)
+            except ldap.SERVER_DOWN:
+                # We lost connection, reconnect and try again
+                self._discard(conn)
+                conn = None
+                conn = await self._create_connection(uri, dn, password)
+                await result(conn, conn.simple_bind(user_dn, user_password), 10)
+
+            # like LDAPAuthPool, the connection stays bound as user_dn until the next bind
+            yield conn
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT, asyncio.CancelledError):
+            if conn is not None:
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            await self._release(slot, conn)
+
+
+class AsyncJaneus(object):
+    @asynccontextmanager
+    async def _connection(self, uri):
+        pool = AsyncLDAPPool(getattr(settings, 'JANEUS_POOL_MAX_SIZE', 8))
+        async with pool.connection(uri, settings.JANEUS_DN, settings.JANEUS_PASS) as conn:
+            yield conn
+
+    async def _search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, timeout=None, operation=None):
+        if timeout is None:
+            timeout = Janeus._timeout(operation)
+        router = ServerRouter()
+        servers = router.read_servers()
+        single = len(servers) == 1
+        if single:
+            # the pooled connection may be lost, so try once more with a new one
+            servers = servers * 2
+        for i, uri in enumerate(servers):
+            start = time.time()
+            try:
+                async with self._connection(uri) as conn:
+                    rtype, rdata, rctrls = await result(conn, conn.search_ext(base, scope, filterstr, attrlist), timeout)
+            except RETIRE_ERRORS as e:
+                router.record(uri, failed=True)
+                if isinstance(e, ldap.TIMEOUT):
+                    LatencyTracker().record(operation, time.time() - start)
+                if i == len(servers) - 1 or (single and not isinstance(e, ldap.SERVER_DOWN)):
+                    raise
+                continue
+            duration = time.time() - start
+            router.record(uri, duration)
+            LatencyTracker().record(operation, duration)
+            return rdata
+
+    @staticmethod
+    async def _cache_call(func, *args):
+        """Calls a method of JaneusCache, in a thread if it uses the shared cache"""
+        if JaneusCache._shared() is None:
+            return func(*args)
+        return await blocking(func, *args)
+
+    @classmethod
+    async def _cached(cls, kind, key, fetch):
+        cache = JaneusCache()
+        if not cache.enabled():
+            return await fetch()
+        hit, value = await cls._cache_call(cache.get, kind, key)
+        if hit:
+            return value
+        value = await fetch()
+        await cls._cache_call(cache.set, kind, key, value)
+        return value
+
+    async def by_uid(self, uid):
+        """Opvragen (dn, attrs) van gebruiker met uid, of geeft None terug als niet uniek gevonden"""
+        async def fetch():
+            baseDN = "ou=users,dc=jd,dc=nl"
+            searchFilter = filter_format('(uid=%s)', (str(uid),))
+            result_data = await self._search(baseDN, ldap.SCOPE_ONELEVEL, searchFilter,
+                                             Janeus._attributes('by_uid'), operation='by_uid')
+            if len(result_data) != 1:
+                return None
+            return entry(result_data[0])
+        return await self._cached('uid', uid, fetch)
+
+    async def groups_of_dn(self, dn, nested=None):
+        """Geeft alle groepen (dn) waarvan de gebruiker lid is.
+        Met nested ook de groepen waarvan die groepen lid zijn (standaard JANEUS_NESTED_GROUPS)
+        """
+        nested = Janeus._nested(nested)
+
+        async def fetch():
+            baseDN = "ou=groups,dc=jd,dc=nl"
+            attrlist = Janeus._attributes('groups_of_dn', 'cn')
+            groups = []
+            seen = set()
+            todo = [dn]
+            while todo:
+                searchFilter = filter_format('(&(objectClass=groupOfNames)(member=%s))', (str(todo.pop()),))
+                for dn2, attrs in await self._search(baseDN, ldap.SCOPE_SUBTREE, searchFilter, attrlist, operation='groups_of_dn'):
+                    if dn2.lower() not in seen:
+                        seen.add(dn2.lower())
+                        groups.append(attrs['cn'][0])
+                        if nested:
+                            todo.append(dn2)
+            return groups
+        return await self._cached('nested_groups' if nested else 'groups', dn, fetch)
+
+    async def groups_of_entry(self, dn, attrs):
+        """Geeft alle groepen waarvan de gebruiker (dn, attrs) lid is, uit memberOf indien aanwezig"""
+        groups = Janeus._memberof_groups(attrs)
+        if groups is None:
+            return await self.groups_of_dn(dn)
+        return groups
+
+    async def members_of_group(self, group):
+        """Geeft alle leden (dn,attrs) die lid zijn van de groep"""
+        baseDN = "ou=users,dc=jd,dc=nl"
+        searchFilter = filter_format('(&(objectClass=inetOrgPerson)(memberOf=cn=%s,ou=groups,dc=jd,dc=nl))', (str(group),))
+        result_data = await self._search(baseDN, ldap.SCOPE_SUBTREE, searchFilter,
+                                         Janeus._attributes('members_of_group'), operation='members_of_group')
+        return [JaneusEntry(dn, attrs) for dn, attrs in result_data]
+
+    async def login(self, uid, password):
+        """Probeert in te loggen met uid+password, geeft (dn, attrs, groups) of None indien mislukt.
+        Zoals Janeus.login, maar de throttle cache wordt in een thread gebruikt.
+        """
+        if throttle.enabled() and await blocking(throttle.is_unknown, uid):
+            return None
+        res = await self.by_uid(uid)
+        if res is None:
+            if throttle.enabled():
+                await blocking(throttle.record_unknown, uid)
+            return None
+        dn, attrs = res
+        if not await self.test_login(dn, password):
+            return None
+        return dn, attrs, await self.groups_of_entry(dn, attrs)
+
+    async def test_login(self, dn, password):
+        """Probeert in te loggen met dn+password, True/False indien gelukt/mislukt"""
+        if not password:
+            # een bind zonder wachtwoord is een anonieme bind, die altijd lukt
+            return False
+        pool = AsyncLDAPAuthPool(getattr(settings, 'JANEUS_AUTH_POOL_SIZE', 4))
+        try:
+            async with pool.bind(ServerRouter().primary(), settings.JANEUS_DN, settings.JANEUS_PASS, dn, password):
+                return True
+        except ldap.INVALID_CREDENTIALS:
+            return False
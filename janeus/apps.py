@@ -0,0 +1,25 @@
+from threading import Thread
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
+
+
+def _warm_up(sender, **kwargs):
+    # only the first request of this process warms up, and it does not wait for it
+    if not request_started.disconnect(_warm_up, dispatch_uid='janeus.warm_up'):
+        return
+    from janeus import Janeus
+    Thread(target=Janeus().warm_up, name='janeus-warm-up', daemon=True).start()
+
+
+class JaneusConfig(AppConfig):
+    name = 'janeus'
+
+    def ready(self):
+        from janeus import roles, sites
+        roles.connect_signals()
+        sites.connect_signals()
+
+        if getattr(settings, 'JANEUS_POOL_WARM_UP', False) and not hasattr(settings, 'JANEUS_FAKE_LDAP'):
+            # not in ready() itself, so management commands do not open connections
+            request_started.connect(_warm_up, dispatch_uid='janeus.warm_up')
@@ -1,16 +1,21 @@
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Permission
 from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
+from django.db import connection
+from django.utils.encoding import force_text
 import logging
-from janeus import Janeus
+from threading import Lock, Thread
+from janeus import Janeus, roles as janeus_roles, sites as janeus_sites, throttle, tracing
 from janeus.models import JaneusUser, JaneusRole
 
 logger = logging.getLogger(__name__)
 
+# uids of which the LDAP groups are being refreshed in the background
+_refreshing = set()
+_refreshing_lock = Lock()
+
 
 class JaneusBackend(object):
     @staticmethod
@@ -41,10 +46,83 @@ class JaneusBackend(object):
             dn, attrs = res
 
             # get groups of dn
-            return attrs, Janeus().groups_of_dn(dn)
+            return attrs, Janeus().groups_of_entry(dn, attrs)
+
+    @staticmethod
+    def login_attrs_groups(username, password, request=None):
+        """Authenticates the user and returns (attrs, groups), or None if authentication fails"""
+        if throttle.is_throttled(username, request):
+            logger.warning('Too many failed logins for {}, not trying to authenticate'.format(username))
+            return None
+        if hasattr(settings, 'JANEUS_FAKE_LDAP'):
+            groups = settings.JANEUS_FAKE_LDAP(username, password)
+            res = None if groups is None else (None, groups)
+        else:
+            logger.info('Trying to authenticate {} in LDAP'.format(username))
+            res = Janeus().login(username, password)
+            if res is not None:
+                dn, attrs, groups = res
+                res = attrs, groups
+        if res is None:
+            throttle.record_failure(username, request)
+        return res
 
     @staticmethod
-    def current_site_id():
+    def store_groups(juser, groups):
+        """Stores a snapshot of the LDAP groups of juser in the database, unless it is recent and unchanged"""
+        snapshot = juser.get_ldap_groups()
+        if snapshot is not None and not juser.ldap_groups_stale() and \
+                sorted(snapshot) == sorted(force_text(g) for g in groups):
+            return
+        juser.set_ldap_groups(groups)
+        juser.save(update_fields=['ldap_groups', 'ldap_groups_updated'])
+
+    @staticmethod
+    def update_user(user, attrs):
+        """Sets the name and email address from LDAP on user, returns the names of the fields that changed"""
+        changed = []
+        for field, attr in (('last_name', 'sn'), ('email', 'mail')):
+            if attr in attrs:
+                value = force_text(attrs[attr][0])
+                if getattr(user, field) != value:
+                    setattr(user, field, value)
+                    changed.append(field)
+        return changed
+
+    @staticmethod
+    def refresh_groups(juser):
+        """Refreshes the snapshot of the LDAP groups of juser, in a background thread if so configured"""
+        def refresh():
+            attrs, groups = JaneusBackend.get_attrs_groups(juser.uid)
+            # a user that no longer exists in LDAP has no groups
+            JaneusBackend.store_groups(juser, groups or [])
+
+        if not getattr(settings, 'JANEUS_GROUPS_REFRESH_BACKGROUND', True):
+            refresh()
+            return
+
+        with _refreshing_lock:
+            if juser.uid in _refreshing:
+                return
+            _refreshing.add(juser.uid)
+
+        def run():
+            try:
+                refresh()
+            except Exception:
+                logger.exception('Could not refresh LDAP groups of {}'.format(juser.uid))
+            finally:
+                with _refreshing_lock:
+                    _refreshing.discard(juser.uid)
+                connection.close()
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def current_site_id(request=None):
+        """Returns the id of the current site, taken from request (default the current request)"""
         if hasattr(settings, 'JANEUS_CURRENT_SITE'):
             if callable(settings.JANEUS_CURRENT_SITE):
                 site = settings.JANEUS_CURRENT_SITE()
@@ -55,44 +133,64 @@ class JaneusBackend(object):
             from mezzanine.utils.sites import current_site_id
             return current_site_id()
         else:
-            from django.contrib.sites.shortcuts import get_current_site
             from janeus.utils import current_request
-            site = get_current_site(current_request())
-            return site.id if isinstance(site, Site) else None
+            return janeus_sites.site_id_for_request(current_request() if request is None else request)
 
     def authenticate(self, username=None, password=None):
-        # authenticate
-        if not JaneusBackend.login(username, password):
+        # authenticate and get LDAP attributes and groups of user
+        with tracing.span('authenticate.ldap'):
+            res = JaneusBackend.login_attrs_groups(username, password)
+        if res is None:
             return None
+        attrs, groups = res
+        with tracing.span('authenticate.database'):
+            return self.get_or_create_user(username, attrs, groups)
+
+    async def aauthenticate(self, request=None, username=None, password=None):
+        """Asynchronous version of authenticate, for ASGI deployments.
+        Django only calls aauthenticate from version 5.0 on, so call it directly.
+        Throttling and the current site use request instead of the current request of the thread.
+        """
+        from asgiref.sync import sync_to_async
+        from janeus.aio import AsyncJaneus, blocking
+        if hasattr(settings, 'JANEUS_FAKE_LDAP'):
+            res = await sync_to_async(JaneusBackend.login_attrs_groups)(username, password, request)
+        elif throttle.enabled() and await blocking(throttle.is_throttled, username, request):
+            logger.warning('Too many failed logins for {}, not trying to authenticate'.format(username))
+            res = None
+        else:
+            logger.info('Trying to authenticate {} in LDAP'.format(username))
+            res = await AsyncJaneus().login(username, password)
+            if res is None:
+                if throttle.enabled():
+                    await blocking(throttle.record_failure, username, request)
+            else:
+                dn, attrs, groups = res
+                res = attrs, groups
+        if res is None:
+            return None
+        attrs, groups = res
+        return await sync_to_async(self.get_or_create_user)(username, attrs, groups, request)
 
-        # get LDAP attributes and groups of user
-        attrs, groups = JaneusBackend.get_attrs_groups(username)
+    def get_or_create_user(self, username, attrs, groups, request=None):
+        """ Returns the User of authenticated LDAP user username, or None if the user has no access """
         groups = groups or []
         if len(groups) == 0:
             return None
 
-        # find all roles of this user, if any
-        roles = JaneusRole.objects.filter(role__in=groups)
-        if len(roles) == 0:
+        # find all roles of this user and the sites they give access to, if any
+        site = JaneusBackend.current_site_id(request)
+        role_pks, site_pks, current_pks = janeus_roles.resolve(groups, site)
+        if len(role_pks) == 0:
             return None
 
-        # determine the sites user has any access to
-        if len(roles.filter(sites=None)) > 0:
-            # user has access to all sites
-            sites = Site.objects.all()
-        else:
-            # user has access to some sites
-            sites_query = '{}__in'.format(JaneusRole._meta.get_field('sites').related_query_name())
-            sites = Site.objects.filter(**{sites_query: roles})
+        # check if user gets access to the current site
+        if site is not None and site_pks is not None and site not in site_pks:
+            return None
 
-        # find current site
-        site = JaneusBackend.current_site_id()
-        if site is not None:
-            # check if user gets access
-            if site not in [s.pk for s in sites]:
-                return None
-            # restrict roles to roles of the current site
-            roles = roles.filter(Q(sites=None) | Q(sites__id__exact=site))
+        # roles of the current site and sites with access (not evaluated unless used)
+        roles = JaneusRole.objects.filter(pk__in=current_pks)
+        sites = Site.objects.all() if site_pks is None else Site.objects.filter(pk__in=site_pks)
 
         # get or create JaneusUser object
         try:
@@ -120,26 +218,32 @@ class JaneusBackend(object):
                 juser.user.save()
             juser.save()
 
-        # now update attributes of user
+        # store snapshot of the groups, used for permission checks in later requests
+        JaneusBackend.store_groups(juser, groups)
+
+        # now update attributes of user, if they changed
         if attrs is not None:
-            setattr(juser.user, 'last_name', attrs['sn'][0])
-            setattr(juser.user, 'email', attrs['mail'][0])
-            juser.user.save()
+            changed = JaneusBackend.update_user(juser.user, attrs)
+            if changed:
+                juser.user.save(update_fields=changed)
 
         # Mezzanine support
         if apps.is_installed('mezzanine.core'):
             from mezzanine.core.models import SitePermission
             sp, created = SitePermission.objects.get_or_create(user=juser.user)
-            # if set in the settings, clear sp.sites before adding site permissions
-            if getattr(settings, 'JANEUS_MEZZANINE_CLEAR_SITEPERMISSION', False):
-                sp.sites.clear()
-            sp.sites.add(*sites)
-            sp.save()
+            site_ids = set(janeus_sites.all_site_ids() if site_pks is None else site_pks)
+            current = set() if created else set(sp.sites.values_list('pk', flat=True))
+            # if set in the settings, remove the site permissions the user no longer has
+            if getattr(settings, 'JANEUS_MEZZANINE_CLEAR_SITEPERMISSION', False) and current - site_ids:
+                sp.sites.remove(*(current - site_ids))
+            if site_ids - current:
+                sp.sites.add(*(site_ids - current))
 
         # add information to User object
         juser.user._janeus_user = juser
         juser.user._janeus_groups = groups
         juser.user._janeus_roles = roles  # all roles of current site
+        juser.user._janeus_site = site
         juser.user._janeus_sites = sites  # all sites with access
 
         return juser.user
@@ -167,70 +271,64 @@ class JaneusBackend(object):
         if hasattr(user_obj, '_janeus_groups'):
             jgroups = user_obj._janeus_groups
         else:
-            attrs, jgroups = JaneusBackend.get_attrs_groups(juser.uid)
+            jgroups = juser.get_ldap_groups()
             if jgroups is None:
-                return False
+                # no snapshot yet, so ask LDAP now
+                attrs, jgroups = JaneusBackend.get_attrs_groups(juser.uid)
+                if jgroups is None:
+                    return False
+                JaneusBackend.store_groups(juser, jgroups)
+            elif juser.ldap_groups_stale():
+                # use the snapshot for this request, but refresh it
+                JaneusBackend.refresh_groups(juser)
             user_obj._janeus_groups = jgroups
 
-        # set Janeus roles (part 1)
-        if hasattr(user_obj, '_janeus_roles'):
-            jroles = user_obj._janeus_roles
-        else:
-            jroles = JaneusRole.objects.filter(role__in=jgroups)
-
-        # set Janeus sites
-        if hasattr(user_obj, '_janeus_sites'):
-            jsites = user_obj._janeus_sites
+        # find current site
+        if hasattr(user_obj, '_janeus_site'):
+            site = user_obj._janeus_site
         else:
-            # determine the sites user has any access to
-            if len(jroles.filter(sites=None)) > 0:
-                # user has access to all sites
-                jsites = Site.objects.all()
-            else:
-                # user has access to some sites
-                sites_query = '{}__in'.format(JaneusRole._meta.get_field('sites').related_query_name())
-                jsites = Site.objects.filter(**{sites_query: jroles})
-            user_obj._janeus_sites = jsites
-
-        # set Janeus roles (part 2)
-        if not hasattr(user_obj, '_janeus_roles'):
-            # find current site
             site = JaneusBackend.current_site_id()
-            if site is not None:
-                # restrict roles to roles of the current site
-                jroles = jroles.filter(Q(sites=None) | Q(sites__id__exact=site))
-            user_obj._janeus_roles = jroles
+            user_obj._janeus_site = site
+
+        # set Janeus roles and sites (not evaluated unless used)
+        if not hasattr(user_obj, '_janeus_roles') or not hasattr(user_obj, '_janeus_sites'):
+            role_pks, site_pks, current_pks = janeus_roles.resolve(jgroups, site)
+            if not hasattr(user_obj, '_janeus_roles'):
+                user_obj._janeus_roles = JaneusRole.objects.filter(pk__in=current_pks)
+            if not hasattr(user_obj, '_janeus_sites'):
+                if site_pks is None:
+                    # user has access to all sites
+                    user_obj._janeus_sites = Site.objects.all()
+                else:
+                    user_obj._janeus_sites = Site.objects.filter(pk__in=site_pks)
 
         return True
 
+    def set_permissions(self, user_obj):
+        """ Sets _janeus_perm_cache, _janeus_groups_perm_cache and _janeus_app_labels in user object """
+        with tracing.span('permissions') as span:
+            if self.set_janeus_data(user_obj):
+                jperms, gperms = janeus_roles.permissions(user_obj._janeus_groups, user_obj._janeus_site)
+                jperms.update(gperms)
+            else:
+                jperms, gperms = set(), set()
+            span.count = len(jperms)
+        user_obj._janeus_groups_perm_cache = gperms
+        user_obj._janeus_perm_cache = jperms
+        user_obj._janeus_app_labels = set(perm[:perm.index('.')] for perm in jperms)
+
     def get_group_permissions(self, user_obj, obj=None):
         if user_obj.is_anonymous() or obj is not None:
             return set()
         if not hasattr(user_obj, '_janeus_groups_perm_cache'):
-            if self.set_janeus_data(user_obj):
-                jroles = user_obj._janeus_roles
-                gperms_query = 'group__{}__in'.format(JaneusRole._meta.get_field('groups').related_query_name())
-                gperms = Permission.objects.filter(**{gperms_query: jroles})
-                gperms = gperms.values_list('content_type__app_label', 'codename').order_by()
-                gperms = set("%s.%s" % (ct, name) for ct, name in gperms)
-                user_obj._janeus_groups_perm_cache = gperms
-            else:
-                user_obj._janeus_groups_perm_cache = set()
+            self.set_permissions(user_obj)
         return user_obj._janeus_groups_perm_cache
 
     def get_all_permissions(self, user_obj, obj=None):
         if user_obj.is_anonymous() or obj is not None:
             return set()
         if not hasattr(user_obj, '_janeus_perm_cache'):
-            if self.set_janeus_data(user_obj):
-                jroles = user_obj._janeus_roles
-                jperms_query = '{}__in'.format(JaneusRole._meta.get_field('groups').related_query_name())
-                jperms = Permission.objects.filter(**{jperms_query: jroles})
-                jperms = jperms.values_list('content_type__app_label', 'codename').order_by()
-                jperms = set("%s.%s" % (ct, name) for ct, name in jperms)
-                user_obj._janeus_perm_cache = jperms.union(self.get_group_permissions(user_obj, obj))
-            else:
-                user_obj._janeus_perm_cache = set()
+            self.set_permissions(user_obj)
         return user_obj._janeus_perm_cache
 
     def has_perm(self, user_obj, perm, obj=None):
@@ -239,9 +337,8 @@ class JaneusBackend(object):
         return perm in self.get_all_permissions(user_obj, obj)
 
     def has_module_perms(self, user_obj, app_label):
-        if not user_obj.is_active:
+        if not user_obj.is_active or user_obj.is_anonymous():
             return False
-        for perm in self.get_all_permissions(user_obj):
-            if perm[:perm.index('.')] == app_label:
-                return True
-        return False
+        if not hasattr(user_obj, '_janeus_app_labels'):
+            self.set_permissions(user_obj)
+        return app_label in user_obj._janeus_app_labels
@@ -0,0 +1,214 @@
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+from django.conf import settings
+
+
+class JaneusCache(object):
+    """Cache for results of LDAP lookups.
+
+    Entries are kept in an in-process LRU with a TTL per entry. If
+    JANEUS_CACHE_BACKEND names a Django cache, entries are also stored there,
+    so they are shared between worker processes. Empty results (user not
+    found, no groups) are cached with the separate JANEUS_CACHE_NEGATIVE_TTL.
+
+    With a shared cache, delete() also appends the key to an invalidation log
+    there: a counter and one entry per deletion. Every process reads the
+    counter at most once per JANEUS_CACHE_SYNC_INTERVAL seconds and drops the
+    in-process entries of the logged keys, so a deletion reaches all processes
+    without a round-trip per hit. If the log cannot be read completely, the
+    in-process entries are all dropped. An entry copied from the shared cache
+    keeps its expiry time.
+    """
+    SEQUENCE_KEY = 'janeus:invalidations'
+    LOG_KEY = 'janeus:invalidation:{}'
+    LOG_TTL = 3600
+    LOG_MAX_READ = 1000
+
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if 'lock' not in self.__dict__:
+            self.lock = Lock()
+
+        if 'entries' not in self.__dict__:
+            self.entries = OrderedDict()
+            self.sequence = None
+            self.synced = 0
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'JANEUS_CACHE', False)
+
+    @staticmethod
+    def _key(kind, key):
+        return kind, str(key).lower()
+
+    @staticmethod
+    def _shared():
+        alias = getattr(settings, 'JANEUS_CACHE_BACKEND', None)
+        if alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[alias]
+
+    @staticmethod
+    def _shared_key(key):
+        kind, value = key
+        return 'janeus:{}:{}'.format(kind, hashlib.sha1(value.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _ttl(value):
+        if value:
+            return getattr(settings, 'JANEUS_CACHE_TTL', 300)
+        else:
+            return getattr(settings, 'JANEUS_CACHE_NEGATIVE_TTL', 60)
+
+    def _sync(self, shared):
+        """Drops the in-process entries that other processes deleted since the last sync"""
+        now = time.time()
+        if shared is None or now - self.synced < getattr(settings, 'JANEUS_CACHE_SYNC_INTERVAL', 1):
+            return
+        self.synced = now
+
+        sequence = shared.get(self.SEQUENCE_KEY, 0)
+        seen = self.sequence
+        if seen == sequence:
+            return
+
+        keys = None
+        if seen is not None and seen < sequence <= seen + self.LOG_MAX_READ:
+            names = [self.LOG_KEY.format(n) for n in range(seen + 1, sequence + 1)]
+            logged = shared.get_many(names)
+            if len(logged) == len(names):
+                keys = logged.values()
+
+        with self.lock:
+            if seen is None:
+                # first sync of this process, there is nothing to drop yet
+                pass
+            elif keys is None:
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.entries.pop(key, None)
+            self.sequence = sequence
+
+    def _store(self, key, value, expires):
+        size = getattr(settings, 'JANEUS_CACHE_SIZE', 1000)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = expires, value
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def get(self, kind, key):
+        """Returns (hit, value), hit is False if there is no valid entry"""
+        key = self._key(kind, key)
+        shared = self._shared()
+        self._sync(shared)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.time():
+                    self.entries.move_to_end(key)
+                    return True, value
+                del self.entries[key]
+
+        if shared is not None:
+            entry = shared.get(self._shared_key(key))
+            if entry is not None:
+                # entries in the shared cache are wrapped in a tuple, so None can be cached
+                value, expires = entry
+                self._store(key, value, expires)
+                return True, value
+
+        return False, None
+
+    def set(self, kind, key, value):
+        key = self._key(kind, key)
+        ttl = self._ttl(value)
+        expires = time.time() + ttl
+        self._store(key, value, expires)
+
+        shared = self._shared()
+        if shared is not None:
+            shared.set(self._shared_key(key), (value, expires), ttl)
+
+    def delete(self, kind, key):
+        key = self._key(kind, key)
+        with self.lock:
+            self.entries.pop(key, None)
+
+        shared = self._shared()
+        if shared is not None:
+            shared.delete(self._shared_key(key))
+            # log the deletion, so the other processes drop their in-process entry
+            shared.add(self.SEQUENCE_KEY, 0, None)
+            try:
+                sequence = shared.incr(self.SEQUENCE_KEY)
+            except ValueError:
+                # the counter was evicted in between
+                shared.add(self.SEQUENCE_KEY, 0, None)
+                sequence = shared.incr(self.SEQUENCE_KEY)
+            shared.set(self.LOG_KEY.format(sequence), key, self.LOG_TTL)
+
+    def clear(self):
+        """Clears the in-process entries (not the shared cache)"""
+        with self.lock:
+            self.entries.clear()
+
+
+class _Call(object):
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs concurrent calls with the same key once.
+
+    The first caller runs the function, callers that arrive while it runs wait
+    for it and get the same result (or exception).
+    """
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if 'lock' not in self.__dict__:
+            self.lock = Lock()
+
+        if 'calls' not in self.__dict__:
+            self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.value
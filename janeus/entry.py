@@ -0,0 +1,106 @@
+import ldap
+from ldap.dn import dn2str, str2dn
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def dn_key(dn):
+    """Returns dn in one textual form, e.g. without spaces after the commas and in lower case, to compare dns"""
+    dn = _text(dn)
+    try:
+        return dn2str(str2dn(dn)).lower()
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+
+class JaneusEntry(object):
+    """An LDAP entry as returned by the lookups of Janeus.
+
+    Behaves like the (dn, attrs) tuple of python-ldap, so dn, attrs = entry
+    and attrs['mail'][0] keep working. The attributes sn, mail, uid, cn and
+    lidnummer give the first value as text, decoded when used. Like the
+    tuple, an entry only holds the dn and the attrs, decoded values are not
+    kept.
+    """
+    __slots__ = ('dn', 'attrs')
+
+    def __init__(self, dn, attrs):
+        self.dn = dn
+        self.attrs = attrs
+
+    def __getstate__(self):
+        return self.dn, self.attrs
+
+    def __setstate__(self, state):
+        self.dn, self.attrs = state
+
+    def __iter__(self):
+        return iter((self.dn, self.attrs))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.dn, self.attrs)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (JaneusEntry, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        if isinstance(other, (JaneusEntry, tuple)):
+            return tuple(self) < tuple(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'JaneusEntry({!r}, {!r})'.format(self.dn, self.attrs)
+
+    def get(self, name, default=None):
+        """Returns the first value of attribute name as text, or default"""
+        values = self.attrs.get(name)
+        return _text(values[0]) if values else default
+
+    def getlist(self, name):
+        """Returns all values of attribute name as text"""
+        return [_text(value) for value in self.attrs.get(name, [])]
+
+    @property
+    def cn(self):
+        return self.get('cn')
+
+    @property
+    def sn(self):
+        return self.get('sn')
+
+    @property
+    def mail(self):
+        return self.get('mail')
+
+    @property
+    def uid(self):
+        return self.get('uid')
+
+    @property
+    def lidnummer(self):
+        """The lidnummer (cn) as int, or None"""
+        try:
+            return int(self.get('cn'))
+        except (TypeError, ValueError):
+            return None
+
+
+def entry(result):
+    """Returns the JaneusEntry for a (dn, attrs) search result, or None"""
+    if result is None or isinstance(result, JaneusEntry):
+        return result
+    dn, attrs = result
+    return JaneusEntry(dn, attrs)
@@ -0,0 +1,317 @@
+"""In-process stand-in for an LDAP server, for benchmarks and development.
+
+Set JANEUS_SERVER to a fake:// URI to use it instead of a real server:
+
+    fake:///path/to/directory.ldif?latency=0.002&jitter=0.001&failure=0.001
+    fake://?users=1000&groups=20
+
+The first form loads the users and groups from an LDIF file, the second form
+generates users uid=user<i> (password "password<i>") and groups cn=group<j>.
+A generated directory contains the service account cn=janeus,dc=jd,dc=nl with
+password "janeus". Every operation takes latency +/- jitter seconds and fails
+with SERVER_DOWN with probability failure. Like the memberOf overlay, memberOf
+is derived from the member attributes of groupOfNames entries. Entries get a
+modifyTimestamp when they are added or their password changes.
+
+The objects returned by initialize() implement the part of LDAPObject that
+Janeus uses, including the asynchronous API and Simple Paged Results.
+"""
+
+import random
+import re
+import time
+from threading import Lock
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from janeus.entry import _text
+
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
+OPERATIONAL = ('memberof', 'modifytimestamp', 'userpassword')
+
+_directories = {}
+_directories_lock = Lock()
+
+
+def timestamp():
+    """Returns the current time as an LDAP GeneralizedTime"""
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime()).encode()
+
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _parse_filter(s, i=0):
+    """Parses the filter at s[i], returns (node, index after the filter)"""
+    if s[i] != '(':
+        raise ldap.FILTER_ERROR({'desc': 'Bad search filter', 'info': s})
+    i += 1
+    op = s[i]
+    if op in '&|':
+        i += 1
+        subs = []
+        while s[i] == '(':
+            sub, i = _parse_filter(s, i)
+            subs.append(sub)
+        return (op, subs), i + 1
+    if op == '!':
+        sub, i = _parse_filter(s, i + 1)
+        return ('!', sub), i + 1
+    j = s.index(')', i)
+    attr, value = s[i:j].split('=', 1)
+    if attr[-1:] in '<>':
+        return (attr[-1] + '=', attr[:-1].lower(), value), j + 1
+    return ('=', attr.rstrip('~').lower(), value), j + 1
+
+
+def _match(node, index):
+    op = node[0]
+    if op == '&':
+        return all(_match(sub, index) for sub in node[1])
+    if op == '|':
+        return any(_match(sub, index) for sub in node[1])
+    if op == '!':
+        return not _match(node[1], index)
+    attr, value = node[1], node[2]
+    values = index.get(attr, ())
+    if op == '>=':
+        return any(v >= _unescape(value).lower() for v in values)
+    if op == '<=':
+        return any(v <= _unescape(value).lower() for v in values)
+    if value == '*':
+        return bool(values)
+    if '*' in value:
+        pattern = '.*'.join(re.escape(_unescape(part).lower()) for part in value.split('*'))
+        return any(re.match(pattern + '$', v) for v in values)
+    return _unescape(value).lower() in values
+
+
+class FakeDirectory(object):
+    def __init__(self, latency=0.0, jitter=0.0, failure=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure = failure
+        self.entries = {}
+        self.lock = Lock()
+        self.counts = {}
+
+    def load_ldif(self, path):
+        from ldif import LDIFRecordList
+        with open(path) as f:
+            records = LDIFRecordList(f)
+            records.parse()
+        for dn, attrs in records.all_records:
+            self.add(dn, attrs)
+        self.update_memberof()
+
+    def generate(self, users, groups):
+        self.add('cn=janeus,dc=jd,dc=nl', {'objectClass': [b'person'], 'userPassword': [b'janeus']})
+        for i in range(users):
+            self.add('cn={},ou=users,dc=jd,dc=nl'.format(i), {
+                'objectClass': [b'inetOrgPerson'],
+                'cn': [str(i).encode()],
+                'uid': ['user{}'.format(i).encode()],
+                'sn': ['User {}'.format(i).encode()],
+                'mail': ['user{}@example.org'.format(i).encode()],
+                'userPassword': ['password{}'.format(i).encode()],
+            })
+        for j in range(groups):
+            members = ['cn={},ou=users,dc=jd,dc=nl'.format(i).encode() for i in range(j, users, groups)]
+            self.add('cn=group{},ou=groups,dc=jd,dc=nl'.format(j), {
+                'objectClass': [b'groupOfNames'],
+                'cn': ['group{}'.format(j).encode()],
+                'member': members or [b''],
+            })
+        self.update_memberof()
+
+    def add(self, dn, attrs):
+        attrs = dict((name, [v if isinstance(v, bytes) else v.encode('utf-8') for v in values])
+                     for name, values in attrs.items())
+        attrs.setdefault('modifyTimestamp', [timestamp()])
+        self.entries[dn.lower()] = [dn, attrs, None]
+
+    def update_memberof(self):
+        for entry in self.entries.values():
+            entry[1].pop('memberOf', None)
+        for dn, attrs, index in list(self.entries.values()):
+            if b'groupofnames' not in [v.lower() for v in attrs.get('objectClass', [])]:
+                continue
+            for member in attrs.get('member', []):
+                entry = self.entries.get(_text(member).lower())
+                if entry is not None:
+                    entry[1].setdefault('memberOf', []).append(dn.encode('utf-8'))
+        for entry in self.entries.values():
+            entry[2] = dict((name.lower(), [_text(v).lower() for v in values]) for name, values in entry[1].items())
+
+    def count(self, operation):
+        with self.lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+
+    def operations(self):
+        """Returns the total number of operations so far"""
+        with self.lock:
+            return sum(self.counts.values())
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def maybe_fail(self):
+        if self.failure and random.random() < self.failure:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server (injected)"})
+
+    def bind(self, who, cred):
+        if not who and not cred:
+            return
+        entry = self.entries.get(_text(who).lower())
+        if entry is None or not cred or cred.encode('utf-8') not in entry[1].get('userPassword', []):
+            raise ldap.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+
+    def search(self, base, scope, filterstr, attrlist):
+        base = base.lower()
+        if scope != ldap.SCOPE_SUBTREE or base:
+            if base not in self.entries and not any(dn.endswith(',' + base) for dn in self.entries):
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'matched': ''})
+        node, end = _parse_filter(filterstr or '(objectClass=*)')
+        result = []
+        for key, (dn, attrs, index) in self.entries.items():
+            if scope == ldap.SCOPE_BASE:
+                found = key == base
+            elif scope == ldap.SCOPE_ONELEVEL:
+                found = key.partition(',')[2] == base
+            else:
+                found = key == base or key.endswith(',' + base)
+            if found and _match(node, index):
+                result.append((dn, self.select(attrs, attrlist)))
+        return result
+
+    @staticmethod
+    def select(attrs, attrlist):
+        wanted = set(a.lower() for a in attrlist or ['*'])
+        return dict((name, list(values)) for name, values in attrs.items()
+                    if name.lower() in wanted or ('*' in wanted and name.lower() not in OPERATIONAL))
+
+
+class FakeLDAPObject(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.bound = ''
+        self.msgid = 0
+        self.pending = {}
+
+    def _operation(self, name, timeout=-1):
+        """Counts, delays and possibly fails a synchronous operation"""
+        self.directory.count(name)
+        delay = self.directory.delay()
+        if timeout is not None and timeout > 0 and delay > timeout:
+            time.sleep(timeout)
+            raise ldap.TIMEOUT()
+        time.sleep(delay)
+        self.directory.maybe_fail()
+
+    def _start(self, name, operation):
+        """Starts an asynchronous operation, returns the message id"""
+        self.directory.count(name)
+        self.msgid += 1
+        self.pending[self.msgid] = time.time() + self.directory.delay(), operation
+        return self.msgid
+
+    def get_option(self, option):
+        return -1
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        self._operation('bind')
+        self.directory.bind(who, cred)
+        self.bound = who
+
+    def simple_bind(self, who='', cred=''):
+        def operation(msgid):
+            self.directory.maybe_fail()
+            self.directory.bind(who, cred)
+            self.bound = who
+            return ldap.RES_BIND, [], msgid, []
+        return self._start('bind', operation)
+
+    def whoami_s(self):
+        self._operation('whoami')
+        return 'dn:' + self.bound if self.bound else ''
+
+    def unbind_s(self):
+        self.directory.count('unbind')
+
+    def unbind_ext(self, serverctrls=None, clientctrls=None):
+        self.directory.count('unbind')
+
+    def search_st(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0, timeout=-1):
+        self._operation('search', timeout)
+        return self.directory.search(base, scope, filterstr, attrlist)
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.search_st(base, scope, filterstr, attrlist, attrsonly)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        paged = [c for c in serverctrls or [] if c.controlType == SimplePagedResultsControl.controlType]
+
+        def operation(msgid):
+            self.directory.maybe_fail()
+            result = self.directory.search(base, scope, filterstr, attrlist)
+            if not paged:
+                return ldap.RES_SEARCH_RESULT, result, msgid, []
+            start = int(paged[0].cookie or 0)
+            end = start + paged[0].size
+            cookie = str(end).encode() if end < len(result) else b''
+            return ldap.RES_SEARCH_RESULT, result[start:end], msgid, [SimplePagedResultsControl(True, 0, cookie)]
+        return self._start('search', operation)
+
+    def result3(self, msgid=-1, all=1, timeout=None):
+        if msgid not in self.pending:
+            raise ldap.NO_SUCH_OPERATION({'desc': 'No such operation'})
+        ready, operation = self.pending[msgid]
+        wait = ready - time.time()
+        if wait > 0:
+            if timeout is not None and 0 <= timeout < wait:
+                time.sleep(timeout)
+                if timeout == 0:
+                    return None, None, None, None
+                raise ldap.TIMEOUT()
+            time.sleep(wait)
+        del self.pending[msgid]
+        return operation(msgid)
+
+    def abandon(self, msgid):
+        self.pending.pop(msgid, None)
+
+    def passwd_s(self, user, oldpw, newpw):
+        self._operation('passwd')
+        self.directory.bind(user, oldpw)
+        attrs = self.directory.entries[user.lower()][1]
+        attrs['userPassword'] = [newpw.encode('utf-8')]
+        attrs['modifyTimestamp'] = [timestamp()]
+        return None, None
+
+
+def directory(uri):
+    """Returns the FakeDirectory for uri, created on first use"""
+    with _directories_lock:
+        if uri not in _directories:
+            parsed = urlparse(uri)
+            options = dict((key, values[0]) for key, values in parse_qs(parsed.query).items())
+            d = FakeDirectory(float(options.get('latency', 0)), float(options.get('jitter', 0)),
+                              float(options.get('failure', 0)))
+            if parsed.path:
+                d.load_ldif(parsed.path)
+            else:
+                d.generate(int(options.get('users', 100)), int(options.get('groups', 10)))
+            _directories[uri] = d
+        return _directories[uri]
+
+
+def initialize(uri):
+    return FakeLDAPObject(directory(uri))
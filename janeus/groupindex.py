@@ -0,0 +1,136 @@
+"""In-process index of the groups in LDAP, see JANEUS_GROUP_INDEX.
+
+The index holds the member graph of all groupOfNames entries, so groups_of_dn
+and nested group lookups do not need a search. It is built with one paged
+search in a background thread and rebuilt when it is older than
+JANEUS_GROUP_INDEX_REFRESH seconds; until the first build finishes, lookups
+search LDAP as without the index. After a failed build, the next attempt waits
+RETRY_DELAY seconds, doubled after every failure up to the refresh interval.
+"""
+
+import logging
+import time
+from threading import Lock, Thread
+from django.conf import settings
+import ldap
+from janeus.entry import dn_key
+
+logger = logging.getLogger(__name__)
+
+GROUPS = "ou=groups,dc=jd,dc=nl"
+
+# seconds before the first retry after a failed build
+RETRY_DELAY = 5
+
+
+def enabled():
+    return getattr(settings, 'JANEUS_GROUP_INDEX', False)
+
+
+class GroupIndex(object):
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if 'refresh_lock' not in self.__dict__:
+            self.refresh_lock = Lock()
+            self.thread = None
+            self.failures = 0
+            self.retry_at = 0
+            self.built = None
+            # (group dn -> cn, group dn -> member dns, dn -> group dns, dn -> all group dns incl. nested)
+            # replaced as a whole, so readers never see a half built index
+            self.graph = {}, {}, {}, {}
+
+    def build(self, entries):
+        """Builds the index from the groups (dn, attrs) with the attributes cn and member"""
+        cns, members, parents = {}, {}, {}
+        for dn, attrs in entries:
+            key = dn_key(dn)
+            cns[key] = attrs['cn'][0]
+            members[key] = set(dn_key(member) for member in attrs.get('member', []) if member)
+            for member in members[key]:
+                parents.setdefault(member, set()).add(key)
+        self.graph = cns, members, parents, {}
+        self.built = time.time()
+
+    def refresh(self, force=False):
+        """Starts a rebuild in the background when the index is missing or too old, returns True if the index can be used.
+        Meanwhile the old index is used. With force, the index is rebuilt in the current thread.
+        """
+        if force:
+            self._rebuild()
+            return self.built is not None
+        interval = getattr(settings, 'JANEUS_GROUP_INDEX_REFRESH', 300)
+        now = time.time()
+        if self.built is None or now - self.built >= interval:
+            with self.refresh_lock:
+                # a thread of the parent process is not alive after a fork
+                if now >= self.retry_at and (self.thread is None or not self.thread.is_alive()):
+                    self.thread = Thread(target=self._rebuild)
+                    self.thread.daemon = True
+                    self.thread.start()
+        return self.built is not None
+
+    def _rebuild(self):
+        from janeus import Janeus
+        try:
+            self.build(Janeus()._paged_search(
+                GROUPS, ldap.SCOPE_SUBTREE, '(objectClass=groupOfNames)', ['cn', 'member']))
+        except Exception:
+            # keep the old index, if any, and wait longer after every failure
+            self.failures += 1
+            delay = RETRY_DELAY * 2 ** (self.failures - 1)
+            self.retry_at = time.time() + min(delay, getattr(settings, 'JANEUS_GROUP_INDEX_REFRESH', 300))
+            logger.exception('Could not build the group index')
+        else:
+            self.failures = 0
+            self.retry_at = 0
+
+    @staticmethod
+    def _ancestors(graph, key):
+        """Returns the dns of all groups that contain key, directly or through other groups"""
+        cns, members, parents, closure = graph
+        result = closure.get(key)
+        if result is None:
+            seen = set()
+            todo = list(parents.get(key, ()))
+            while todo:
+                group = todo.pop()
+                if group not in seen:
+                    seen.add(group)
+                    todo.extend(parents.get(group, ()))
+            result = closure[key] = frozenset(seen)
+        return result
+
+    def groups_of(self, dn, nested=False):
+        """Returns the cn of the groups of dn, or None if dn is not a member of any group"""
+        graph = self.graph
+        cns, members, parents, closure = graph
+        key = dn_key(dn)
+        if key not in parents:
+            return None
+        groups = self._ancestors(graph, key) if nested else parents[key]
+        return sorted(cns[group] for group in groups)
+
+    def members_of(self, group_dn, nested=False):
+        """Returns the (normalized, see dn_key) dns of the members of a group, or None if the group is unknown.
+        With nested, the members of member groups are included instead of the groups themselves.
+        """
+        cns, members, parents, closure = self.graph
+        key = dn_key(group_dn)
+        if key not in members:
+            return None
+        if not nested:
+            return sorted(members[key])
+        result, seen, todo = set(), set([key]), list(members[key])
+        while todo:
+            member = todo.pop()
+            if member in members:
+                if member not in seen:
+                    seen.add(member)
+                    todo.extend(members[member])
+            else:
+                result.add(member)
+        return sorted(result)
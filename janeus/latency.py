@@ -0,0 +1,57 @@
+from collections import deque
+from threading import Lock
+from django.conf import settings
+
+# percentiles are only used when there are at least this many durations
+MIN_SAMPLES = 20
+
+
+class LatencyTracker(object):
+    """Keeps the last JANEUS_LATENCY_WINDOW durations (in seconds) of every LDAP operation"""
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if 'lock' not in self.__dict__:
+            self.lock = Lock()
+
+        if 'durations' not in self.__dict__:
+            self.durations = {}
+
+    def record(self, operation, duration):
+        window = getattr(settings, 'JANEUS_LATENCY_WINDOW', 200)
+        with self.lock:
+            durations = self.durations.get(operation)
+            if durations is None or durations.maxlen != window:
+                durations = self.durations[operation] = deque(durations or (), window)
+            durations.append(duration)
+
+    def percentile(self, operation, p):
+        """Returns the p-th percentile of the durations of operation, or None if there are too few"""
+        with self.lock:
+            durations = sorted(self.durations.get(operation, ()))
+        if len(durations) < MIN_SAMPLES:
+            return None
+        return durations[int(round(p / 100.0 * (len(durations) - 1)))]
+
+    def stats(self):
+        """Returns a dict operation -> {'count', 'p50', 'p95', 'p99'}"""
+        with self.lock:
+            operations = list(self.durations)
+        result = {}
+        for operation in operations:
+            with self.lock:
+                count = len(self.durations[operation])
+            result[operation] = {
+                'count': count,
+                'p50': self.percentile(operation, 50),
+                'p95': self.percentile(operation, 95),
+                'p99': self.percentile(operation, 99),
+            }
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.durations.clear()
+
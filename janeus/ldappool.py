@@ -1,86 +1,402 @@
-from threading import Condition
+import os
+import time
+from threading import Condition, Lock, Thread
 from contextlib import contextmanager
 import ldap
+from janeus import tracing
+
+# errors after which a connection is not used again
+RETIRE_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT, ldap.UNAVAILABLE)
+
+# the shared state of all pools, see reset_after_fork
+_states = []
+# connections of the parent process, kept so they are never closed (or unbound) by this process
+_inherited = []
+
+
+def reset_after_fork():
+    """Empties all pools if this process is a fork of the process that created them.
+
+    The connections of the parent are not closed, because that would close them
+    for the parent as well; they are kept referenced and never used again.
+    """
+    pid = os.getpid()
+    for state in list(_states):
+        if state.get('pid', pid) == pid:
+            continue
+        for slot in state.get('slots', {}).values():
+            _inherited.extend(pooled.conn for pooled in slot.idle)
+        # the locks may have been held by threads that do not exist in this process
+        state['lock'] = Lock()
+        state['slots'] = {}
+        state['pid'] = pid
+        state.pop('keepalive_thread', None)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def initialize(uri):
+    """Like ldap.initialize, but fake:// URIs give a janeus.fakeldap stand-in"""
+    if uri.startswith('fake:'):
+        from janeus import fakeldap
+        return fakeldap.initialize(uri)
+    return ldap.initialize(uri)
+
+
+class Histogram(object):
+    """Counts values (durations in seconds) in buckets"""
+    BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        index = 0
+        while index < len(self.BOUNDS) and value > self.BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self):
+        labels = ['<={}'.format(bound) for bound in self.BOUNDS] + ['>{}'.format(self.BOUNDS[-1])]
+        return {'count': self.count, 'total': self.total, 'buckets': dict(zip(labels, self.buckets))}
+
+
+class PooledConnection(object):
+    __slots__ = ('conn', 'created', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.last_used = time.time()
+
+
+class _Slot(object):
+    """The connections for one (uri, dn)"""
+
+    def __init__(self, uri, dn, password):
+        self.uri = uri
+        self.dn = dn
+        self.password = password
+        self.lock = Condition()
+        self.count = 0
+        self.idle = []
+        # statistics
+        self.checkouts = 0
+        self.waits = 0
+        self.creations = 0
+        self.reconnects = 0
+        self.wait_time = Histogram()
+        self.hold_time = Histogram()
+
+    def stats(self):
+        return {
+            'uri': self.uri,
+            'dn': self.dn,
+            'in_use': self.count - len(self.idle),
+            'idle': len(self.idle),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'creations': self.creations,
+            'reconnects': self.reconnects,
+            'wait_time': self.wait_time.as_dict(),
+            'hold_time': self.hold_time.as_dict(),
+        }
 
 
 class LDAPPool(object):
+    """Pool of connections, bound with a dn and password.
+
+    Connections are only checked with whoami_s when they have been idle for
+    more than idle_probe seconds. Connections older than max_age seconds or
+    that raised a connection error are closed. If keepalive is set, a
+    background thread checks the idle connections every keepalive seconds and
+    keeps at least min_idle connections open.
+
+    The pool is fork safe: a process that forked gets empty pools, see
+    reset_after_fork. Use warm_up to open connections in advance.
+
+    The pool keeps statistics per (uri, dn), see stats(). If metrics is set,
+    it is called as metrics(event, uri, dn, value) for the events 'checkout',
+    'wait' (seconds), 'hold' (seconds), 'create' and 'reconnect'.
+    """
     __shared_state = {}
 
-    def __init__(self, connection_limit=8):
+    def __init__(self, connection_limit=8, idle_probe=30, max_age=3600, min_idle=0, keepalive=None, metrics=None):
         self.__dict__ = self.__shared_state
+        self._setup(connection_limit, idle_probe, max_age, min_idle, keepalive, metrics)
+
+    def _setup(self, connection_limit, idle_probe=30, max_age=3600, min_idle=0, keepalive=None, metrics=None):
+        if 'pid' not in self.__dict__:
+            self.pid = os.getpid()
+            _states.append(self.__dict__)
+        elif self.pid != os.getpid():
+            # forked without os.register_at_fork
+            reset_after_fork()
 
         if 'lock' not in self.__dict__:
-            self.lock = Condition()
+            self.lock = Lock()
 
-        if 'connections' not in self.__dict__:
-            self.connections = {}
+        if 'slots' not in self.__dict__:
+            self.slots = {}
 
-        if 'connection_limit' not in self.__dict__:
-            self.connection_limit = connection_limit
+        self.__dict__.setdefault('connection_limit', connection_limit)
+        self.__dict__.setdefault('idle_probe', idle_probe)
+        self.__dict__.setdefault('max_age', max_age)
+        self.__dict__.setdefault('min_idle', min_idle)
+        self.__dict__.setdefault('keepalive', keepalive)
+        self.__dict__.setdefault('metrics', metrics)
 
     def _create_connection(self, uri, dn, password):
-        conn = ldap.initialize(uri)
+        conn = initialize(uri)
         conn.simple_bind_s(dn, password)
         return conn
 
-    @contextmanager
-    def connection(self, uri, dn, password):
-        # Get data for uri
+    def _new(self, slot, reconnect=False):
+        """Creates a new PooledConnection for slot"""
+        with tracing.span('connect', slot.uri, slot.dn):
+            pooled = PooledConnection(self._create_connection(slot.uri, slot.dn, slot.password))
+        with slot.lock:
+            slot.creations += 1
+            if reconnect:
+                slot.reconnects += 1
+        self._event('create', slot, 1)
+        if reconnect:
+            self._event('reconnect', slot, 1)
+        return pooled
+
+    def _event(self, event, slot, value):
+        if self.metrics is not None:
+            self.metrics(event, slot.uri, slot.dn, value)
+
+    def stats(self):
+        """Returns a list with the statistics of every (uri, dn)"""
+        with self.lock:
+            slots = list(self.slots.values())
+        result = []
+        for slot in slots:
+            with slot.lock:
+                result.append(slot.stats())
+        return result
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _slot(self, uri, dn, password):
         with self.lock:
-            if uri not in self.connections:
-                self.connections[uri] = Condition(), {}
-            lock, connections = self.connections[uri]
-
-        # Get data for dn
-        with lock:
-            if dn not in connections:
-                connections[dn] = Condition(), [0], []
-            lock, counter, connections = connections[dn]
-
-        # Acquire or create a connection
-        with lock:
-            if connections:
+            if (uri, dn) not in self.slots:
+                self.slots[uri, dn] = _Slot(uri, dn, password)
+                self._start_keepalive()
+            return self.slots[uri, dn]
+
+    def _acquire(self, uri, dn, password, block=True):
+        """Returns (slot, pooled), or None if block is False and no connection is available"""
+        slot = self._slot(uri, dn, password)
+        start = time.time()
+
+        # Acquire a connection or reserve a new one
+        with slot.lock:
+            if not block and not slot.idle and slot.count >= self.connection_limit:
+                return None
+            slot.checkouts += 1
+            contended = not slot.idle and slot.count >= self.connection_limit
+            if contended:
+                slot.waits += 1
+            while not slot.idle and slot.count >= self.connection_limit:
+                # Must wait for connection
+                slot.lock.wait()
+            waited = time.time() - start
+            slot.wait_time.add(waited)
+            if slot.idle:
                 # Connection from pool
-                conn = connections.pop()
-            elif counter[0] < self.connection_limit:
-                # No available, but below connection limit
-                conn = self._create_connection(uri, dn, password)
-                counter[0] += 1
+                pooled = slot.idle.pop()
             else:
-                # Must wait for connection
-                lock.wait()
-                if connections:
-                    # (Expected) a connection is available
-                    conn = connections.pop()
-                else:
-                    # We were notified, but no connection: create new one
-                    conn = self._create_connection(uri, dn, password)
-                    counter[0] += 1
+                pooled = None
+                slot.count += 1
+        self._event('checkout', slot, 1)
+        self._event('wait', slot, waited)
+        if contended:
+            tracing.record('pool_wait', waited, slot.uri, slot.dn)
+
+        if pooled is None:
+            # No available, but below connection limit
+            try:
+                pooled = self._new(slot)
+            except BaseException:
+                self._release(slot, None)
+                raise
+        return slot, pooled
+
+    def _release(self, slot, pooled, held=None):
+        if held is not None:
+            with slot.lock:
+                slot.hold_time.add(held)
+            self._event('hold', slot, held)
+
+        if pooled is not None and time.time() - pooled.created > self.max_age:
+            # Retire old connection
+            self._discard(pooled.conn)
+            pooled = None
+
+        with slot.lock:
+            if pooled is not None:
+                pooled.last_used = time.time()
+                slot.idle.append(pooled)
+            else:
+                slot.count -= 1
+            slot.lock.notify()
+
+    def _purge(self, slot):
+        """Closes all idle connections of slot, e.g. after the server went down"""
+        with slot.lock:
+            idle, slot.idle = slot.idle, []
+            slot.count -= len(idle)
+            slot.lock.notify_all()
+        for pooled in idle:
+            self._discard(pooled.conn)
+
+    @contextmanager
+    def connection(self, uri, dn, password, block=True):
+        """Yields a connection; with block False, yields None instead of waiting for one"""
+        acquired = self._acquire(uri, dn, password, block)
+        if acquired is None:
+            yield None
+            return
+        slot, pooled = acquired
+        start = time.time()
 
         # From this point, we MUST free one waiter with notify.
         try:
+            if start - pooled.last_used > self.idle_probe:
+                # Connection was idle for a while, check if it still works
+                try:
+                    pooled.conn.whoami_s()
+                except ldap.LDAPError:
+                    self._discard(pooled.conn)
+                    pooled = None
+                    # We lost connection, reconnect
+                    pooled = self._new(slot, reconnect=True)
+                    # if reconnect fails, pooled == None in the finally block
+
+            # OK, we got a connection. Let's go!
+            yield pooled.conn
+        except RETIRE_ERRORS as e:
+            if pooled is not None:
+                self._discard(pooled.conn)
+                pooled = None
+            if isinstance(e, ldap.SERVER_DOWN):
+                # the other idle connections are most likely lost as well
+                self._purge(slot)
+            raise
+        finally:
+            self._release(slot, pooled, time.time() - start)
+
+    def _maintain(self, slot):
+        """Checks the idle connections of slot and opens connections until there are min_idle"""
+        now = time.time()
+        with slot.lock:
+            # take out the connections to check, they stay counted
+            check = [p for p in slot.idle if now - p.last_used > self.idle_probe or now - p.created > self.max_age]
+            slot.idle = [p for p in slot.idle if p not in check]
+
+        for pooled in check:
             try:
-                conn.whoami_s()
-            except ldap.SERVER_DOWN:
-                conn = None
+                pooled.conn.whoami_s()
             except ldap.LDAPError:
-                # Could report error here
+                self._discard(pooled.conn)
+                pooled = None
+            self._release(slot, pooled)
+
+        self._fill(slot, self.min_idle)
+
+    def _fill(self, slot, count):
+        """Opens connections until slot has count idle connections or reaches the connection limit"""
+        while True:
+            with slot.lock:
+                if len(slot.idle) >= count or slot.count >= self.connection_limit:
+                    return
+                slot.count += 1
+            try:
+                pooled = self._new(slot)
+            except BaseException:
+                self._release(slot, None)
+                raise
+            self._release(slot, pooled)
+
+    def warm_up(self, uri, dn, password, count=None):
+        """Opens connections for (uri, dn) until there are count (default min_idle) idle connections"""
+        self._fill(self._slot(uri, dn, password), self.min_idle if count is None else count)
+
+    def _start_keepalive(self):
+        if self.keepalive and 'keepalive_thread' not in self.__dict__:
+            self.keepalive_thread = Thread(target=self._keepalive)
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    def _keepalive(self):
+        while True:
+            time.sleep(self.keepalive)
+            with self.lock:
+                slots = list(self.slots.values())
+            for slot in slots:
                 try:
-                    conn.unbind_s()
-                finally:
-                    conn = None
+                    self._maintain(slot)
+                except ldap.LDAPError:
+                    # try again next time
+                    pass
 
-            if conn is None:
-                # We lost connection, reconnect
-                conn = self._create_connection(uri, dn, password)
-                # if reconnect fails, conn == None in the finally block
 
-            # OK, we got a connection. Let's go!
-            yield conn
+class LDAPAuthPool(LDAPPool):
+    """Pool of connections for verifying passwords of users.
+
+    New connections are bound with the given dn and password. For every
+    attempt, the connection is bound as the user and returned to the pool as
+    it is: the next attempt binds it again, so restoring the identity of the
+    pool would only cost a round-trip. Because a pooled connection can be
+    bound as any user, connections are only handed out by bind(), and
+    connection() raises TypeError. Connections that raised a connection error
+    are discarded.
+    """
+    __shared_state = {}
+
+    def __init__(self, connection_limit=4, max_age=3600, metrics=None):
+        self.__dict__ = self.__shared_state
+        self._setup(connection_limit, max_age=max_age, metrics=metrics)
+
+    def connection(self, uri, dn, password, block=True):
+        raise TypeError('connections of LDAPAuthPool are bound as users, use bind()')
+
+    @contextmanager
+    def bind(self, uri, dn, password, user_dn, user_password):
+        """Yields a connection bound as user_dn, raises ldap.INVALID_CREDENTIALS if that fails"""
+        slot, pooled = self._acquire(uri, dn, password)
+        start = time.time()
+
+        # From this point, we MUST free one waiter with notify.
+        try:
+            with tracing.span('bind', uri, user_dn):
+                try:
+                    pooled.conn.simple_bind_s(user_dn, user_password)
+                except ldap.SERVER_DOWN:
+                    # We lost connection, reconnect and try again
+                    self._discard(pooled.conn)
+                    pooled = None
+                    pooled = self._new(slot, reconnect=True)
+                    pooled.conn.simple_bind_s(user_dn, user_password)
+
+            yield pooled.conn
+        except RETIRE_ERRORS:
+            if pooled is not None:
+                self._discard(pooled.conn)
+                pooled = None
+            raise
         finally:
-            with lock:
-                if conn is not None:
-                    connections.append(conn)
-                else:
-                    counter[0] -= 1
-                lock.notify()
+            self._release(slot, pooled, time.time() - start)
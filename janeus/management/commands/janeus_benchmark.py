@@ -0,0 +1,103 @@
+from __future__ import print_function
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import ldap
+from ldap.filter import filter_format
+from janeus import Janeus, fakeldap
+from janeus.backend import JaneusBackend
+from janeus.cache import JaneusCache
+from janeus.servers import configured_servers
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+class Command(BaseCommand):
+    help = ('Measures the latency of the Janeus authentication hot paths. '
+            'Authenticating creates users in the database, so use a test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', default='user0', help='User to authenticate')
+        parser.add_argument('--password', default='password0', help='Password of the user')
+        parser.add_argument('--group', default='group0', help='Group for members_of_group')
+        parser.add_argument('--iterations', type=int, default=100, help='Number of calls per measurement')
+        parser.add_argument('--threads', default='1,2,4,8,16,32,64',
+                            help='Comma separated numbers of threads for the pool contention measurement')
+
+    def handle(self, *args, **options):
+        if hasattr(settings, 'JANEUS_FAKE_LDAP'):
+            raise CommandError('JANEUS_FAKE_LDAP bypasses LDAP, use a fake:// JANEUS_SERVER instead')
+        primary = configured_servers()[0]
+        self.directory = fakeldap.directory(primary) if primary.startswith('fake:') else None
+        n = options['iterations']
+        backend = JaneusBackend()
+        username, password = options['username'], options['password']
+
+        user = backend.authenticate(username=username, password=password)
+        if user is None:
+            raise CommandError('Could not authenticate {}, does it have a Janeus role?'.format(username))
+
+        def authenticate():
+            JaneusCache().clear()
+            backend.authenticate(username=username, password=password)
+        self.measure('authenticate', authenticate, n)
+
+        def has_perm_cold():
+            backend.has_perm(backend.get_user(user.pk), 'janeus.benchmark')
+        self.measure('has_perm (cold)', has_perm_cold, n)
+
+        warm = backend.get_user(user.pk)
+        backend.has_perm(warm, 'janeus.benchmark')
+        self.measure('has_perm (warm)', lambda: backend.has_perm(warm, 'janeus.benchmark'), n)
+
+        def members_of_group():
+            JaneusCache().clear()
+            Janeus().members_of_group(options['group'])
+        self.measure('members_of_group', members_of_group, n)
+
+        # pool contention, one search per call without the cache
+        searchFilter = filter_format('(uid=%s)', (username,))
+        for threads in [int(t) for t in options['threads'].split(',')]:
+            self.measure_threads(threads, lambda: Janeus()._search(
+                "ou=users,dc=jd,dc=nl", ldap.SCOPE_ONELEVEL, searchFilter, timeout=10), n)
+
+    def operations(self):
+        return self.directory.operations() if self.directory is not None else 0
+
+    def report(self, name, durations, ldap_ops, sql_queries, calls):
+        print("{:<24} n={:<5} p50={:7.2f}ms p90={:7.2f}ms p99={:7.2f}ms max={:7.2f}ms ldap/call={} sql/call={}".format(
+            name, len(durations),
+            1000 * percentile(durations, 50), 1000 * percentile(durations, 90),
+            1000 * percentile(durations, 99), 1000 * max(durations),
+            '{:.2f}'.format(float(ldap_ops) / calls) if self.directory is not None else '-',
+            '{:.2f}'.format(float(sql_queries) / calls) if sql_queries is not None else '-'))
+
+    def measure(self, name, func, n):
+        durations = []
+        ops = self.operations()
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(n):
+                start = time.time()
+                func()
+                durations.append(time.time() - start)
+        self.report(name, durations, self.operations() - ops, len(queries), n)
+
+    def measure_threads(self, threads, func, n):
+        def timed(i):
+            start = time.time()
+            func()
+            return time.time() - start
+
+        ops = self.operations()
+        start = time.time()
+        with ThreadPoolExecutor(threads) as executor:
+            durations = list(executor.map(timed, range(n * threads)))
+        elapsed = time.time() - start
+        self.report('pool, {} threads'.format(threads), durations, self.operations() - ops, None, n * threads)
+        print("{:<24} {:.0f} searches/s".format('', len(durations) / elapsed))
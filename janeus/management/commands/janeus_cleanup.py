@@ -1,35 +1,101 @@
 from __future__ import print_function
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.encoding import force_text
+from janeus import Janeus
 from janeus.models import JaneusUser, JaneusRole
 from janeus.backend import JaneusBackend
 
+# number of objects per database query
+BATCH_SIZE = 500
+
 
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        for u in JaneusUser.objects.all():
-            self.check_user(u)
-
-    def check_user(self, juser):
-        # first we retrieve the groups that the given user <juser.uid> is in
-        attrs, groups = JaneusBackend.get_attrs_groups(juser.uid)
-
-        if groups is None:
-            # the user does not actually exist
-            juser.user.delete()  # cascades
-            print("Deleted unknown user {}".format(juser.uid))
-        else:
-            # retrieve the user's groups that are roles in our database
-            roles = JaneusRole.objects.filter(role__in=groups)
-            if len(roles) == 0:
+    help = 'Deletes Janeus users without access and updates the names and email addresses of the others'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of LDAP searches that run at the same time')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report the changes, but do not change the database')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        jusers = list(JaneusUser.objects.select_related('user'))
+
+        # retrieve the attributes and groups of all users
+        attrs_groups = self.get_attrs_groups([juser.uid for juser in jusers], options['workers'])
+        ldap_done = time.time()
+
+        # compare with the database
+        roles = set(JaneusRole.objects.values_list('role', flat=True))
+        deleted = []
+        updated = []
+        for juser in jusers:
+            attrs, groups = attrs_groups[juser.uid]
+            if groups is None:
+                # the user does not actually exist
+                deleted.append(juser)
+                print("Deleted unknown user {}".format(juser.uid))
+            elif not roles.intersection(force_text(g) for g in groups):
                 # the user has no relevant roles
-                juser.user.delete()  # cascades
+                deleted.append(juser)
                 print("Deleted user without roles {}".format(juser.uid))
+            elif attrs is not None and juser.user is not None and JaneusBackend.update_user(juser.user, attrs):
+                updated.append(juser.user)
+                print("Updated user {}".format(juser.uid))
+
+        if not options['dry_run']:
+            with transaction.atomic():
+                self.save(deleted, updated)
+
+        print("Checked {} users in {:.2f}s (LDAP {:.2f}s, database {:.2f}s): {} deleted, {} updated{}".format(
+            len(jusers), time.time() - start, ldap_done - start, time.time() - ldap_done,
+            len(deleted), len(updated), " (dry run)" if options['dry_run'] else ""))
+
+    @staticmethod
+    def get_attrs_groups(uids, workers):
+        """Returns a dict uid -> (attrs, groups), like JaneusBackend.get_attrs_groups"""
+        if hasattr(settings, 'JANEUS_FAKE_LDAP'):
+            return dict((uid, JaneusBackend.get_attrs_groups(uid)) for uid in uids)
+
+        janeus = Janeus()
+        result = {}
+        without_memberof = {}
+        for uid, res in janeus.by_uids(uids, workers).items():
+            if res is None:
+                result[uid] = None, None
+                continue
+            dn, attrs = res
+            groups = janeus._memberof_groups(attrs)
+            if groups is None:
+                without_memberof[uid] = dn, attrs
             else:
-                # update the attributes, if we received them
-                if attrs is not None:
-                    if 'sn' in attrs:
-                        setattr(juser.user, 'last_name', attrs['sn'][0])
-                    if 'mail' in attrs:
-                        setattr(juser.user, 'email', attrs['mail'][0])
-                    juser.user.save()
-                    print("Updated user {}".format(juser.uid))
+                result[uid] = attrs, groups
+
+        # search the groups of the users that have no memberOf attribute
+        groups = janeus.groups_of_dns([dn for dn, attrs in without_memberof.values()], workers)
+        for uid, (dn, attrs) in without_memberof.items():
+            result[uid] = attrs, groups[dn]
+        return result
+
+    @staticmethod
+    def save(deleted, updated):
+        # deleting the User cascades to the JaneusUser
+        user_pks = [juser.user.pk for juser in deleted if juser.user is not None]
+        juser_pks = [juser.pk for juser in deleted if juser.user is None]
+        model = get_user_model()
+        for i in range(0, len(user_pks), BATCH_SIZE):
+            model.objects.filter(pk__in=user_pks[i:i + BATCH_SIZE]).delete()
+        for i in range(0, len(juser_pks), BATCH_SIZE):
+            JaneusUser.objects.filter(pk__in=juser_pks[i:i + BATCH_SIZE]).delete()
+
+        if hasattr(model.objects, 'bulk_update'):
+            model.objects.bulk_update(updated, ['last_name', 'email'], batch_size=BATCH_SIZE)
+        else:
+            # Django < 2.2
+            for user in updated:
+                user.save(update_fields=['last_name', 'email'])
@@ -0,0 +1,35 @@
+from __future__ import print_function
+import json
+import time
+from django.core.management.base import BaseCommand
+from janeus.poolstats import collect
+
+
+def _avg_ms(histogram):
+    return 1000.0 * histogram['total'] / histogram['count'] if histogram['count'] else 0.0
+
+
+class Command(BaseCommand):
+    help = 'Shows the statistics of the LDAP pools of all worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='Print the statistics as JSON')
+
+    def handle(self, *args, **options):
+        snapshots = collect()
+        if options['json']:
+            print(json.dumps(snapshots, indent=2, sort_keys=True))
+            return
+        if not snapshots:
+            print("No statistics found, is JANEUS_POOL_STATS_CACHE set?")
+            return
+
+        for snapshot in snapshots:
+            print("{} pid {} ({:.0f}s ago)".format(snapshot['host'], snapshot['pid'], time.time() - snapshot['time']))
+            for name, slots in sorted(snapshot['pools'].items()):
+                for s in slots:
+                    print("  {} {} {}: {} in use, {} idle, {} checkouts, {} waits (avg {:.1f} ms), "
+                          "avg hold {:.1f} ms, {} created, {} reconnects".format(
+                              name, s['uri'], s['dn'], s['in_use'], s['idle'], s['checkouts'], s['waits'],
+                              _avg_ms(s['wait_time']), _avg_ms(s['hold_time']), s['creations'], s['reconnects']))
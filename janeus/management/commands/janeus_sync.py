@@ -0,0 +1,41 @@
+from __future__ import print_function
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import ldap
+from janeus import Janeus, mirror
+from janeus.models import JaneusMirrorEntry, JaneusMirrorGroup
+
+
+class Command(BaseCommand):
+    help = ('Copies the users and groups in LDAP to the database, see JANEUS_MIRROR. '
+            'Only changes since the previous run are copied, unless --full is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Copy everything and delete users and groups that no longer exist')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        janeus = Janeus()
+        # no memberOf: the groups of a user come from the members of the groups, see mirror.groups_of_dn
+        attrlist = ['*', 'modifyTimestamp']
+
+        # the first run is always a full copy
+        full = options['full'] or not JaneusMirrorEntry.objects.exists()
+        since = None if full else mirror.last_modified(JaneusMirrorEntry)
+        searchFilter = mirror.filter_since('(objectClass=inetOrgPerson)', since)
+        with transaction.atomic():
+            users = mirror.sync_entries(janeus._paged_search(
+                mirror.USERS, ldap.SCOPE_ONELEVEL, searchFilter, attrlist), full)
+        print("Users: {} created, {} updated, {} deleted".format(*users))
+
+        full = options['full'] or not JaneusMirrorGroup.objects.exists()
+        since = None if full else mirror.last_modified(JaneusMirrorGroup)
+        searchFilter = mirror.filter_since('(objectClass=groupOfNames)', since)
+        with transaction.atomic():
+            groups = mirror.sync_groups(janeus._paged_search(
+                mirror.GROUPS, ldap.SCOPE_SUBTREE, searchFilter, ['cn', 'member', 'modifyTimestamp']), full)
+        print("Groups: {} created, {} updated, {} deleted".format(*groups))
+
+        print("Synchronized in {:.2f}s".format(time.time() - start))
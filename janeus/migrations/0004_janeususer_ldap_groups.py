@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('janeus', '0003_janeusrole_sites'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='janeususer',
+            name='ldap_groups',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='janeususer',
+            name='ldap_groups_updated',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
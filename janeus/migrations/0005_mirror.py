@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('janeus', '0004_janeususer_ldap_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JaneusMirrorEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dn', models.CharField(max_length=250, unique=True)),
+                ('uid', models.CharField(max_length=250, db_index=True, blank=True)),
+                ('lidnummer', models.IntegerField(null=True, db_index=True)),
+                ('mail', models.CharField(max_length=254, db_index=True, blank=True)),
+                ('data', models.TextField()),
+                ('modified', models.CharField(max_length=32, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='JaneusMirrorGroup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dn', models.CharField(max_length=250, unique=True)),
+                ('cn', models.CharField(max_length=250, db_index=True)),
+                ('modified', models.CharField(max_length=32, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='JaneusMirrorMembership',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('member', models.CharField(max_length=250, db_index=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='janeus.JaneusMirrorGroup')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,179 @@
+"""Local copy of the users and groups in LDAP, see the janeus_sync command.
+
+With JANEUS_MIRROR = True, the read methods of Janeus use this copy instead of
+LDAP. Passwords are always checked against LDAP.
+
+The memberOf attribute of users is not copied: an incremental sync only copies
+users whose own modifyTimestamp changed, which is not the case when they are
+removed from a group. The groups of a user come from the copied members of the
+groups instead.
+"""
+
+import json
+from ldap.filter import filter_format
+from janeus.entry import JaneusEntry, _text, dn_key
+from janeus.models import JaneusMirrorEntry, JaneusMirrorGroup, JaneusMirrorMembership
+
+USERS = "ou=users,dc=jd,dc=nl"
+GROUPS = "ou=groups,dc=jd,dc=nl"
+
+# number of objects per database query
+BATCH_SIZE = 500
+
+# attributes that are not copied (in lower case)
+SKIPPED = ('memberof',)
+
+
+def dump(dn, attrs):
+    """Returns the JSON stored for the LDAP entry (dn, attrs), leaving out values that are not text"""
+    values = {}
+    for name, vals in attrs.items():
+        if name.lower() in SKIPPED:
+            continue
+        texts = []
+        for value in vals:
+            try:
+                texts.append(_text(value))
+            except UnicodeDecodeError:
+                # binary data such as jpegPhoto
+                continue
+        values[name] = texts
+    return json.dumps({'dn': dn, 'attrs': values}, sort_keys=True)
+
+
+def load(data):
+    """Returns the JaneusEntry of stored JSON, with bytes values like python-ldap"""
+    data = json.loads(data)
+    attrs = dict((name, [value.encode('utf-8') for value in values])
+                 for name, values in data['attrs'].items() if name.lower() not in SKIPPED)
+    return JaneusEntry(data['dn'], attrs)
+
+
+def entry_fields(dn, attrs):
+    """Returns the field values of a JaneusMirrorEntry for the LDAP entry (dn, attrs)"""
+    def first(name):
+        values = attrs.get(name)
+        return _text(values[0]) if values else ''
+    try:
+        lidnummer = int(first('cn'))
+    except ValueError:
+        lidnummer = None
+    return {
+        'uid': first('uid').lower(),
+        'lidnummer': lidnummer,
+        'mail': first('mail').lower(),
+        'data': dump(dn, attrs),
+        'modified': first('modifyTimestamp'),
+    }
+
+
+def by_dn(dn):
+    entry = JaneusMirrorEntry.objects.filter(dn=dn_key(dn)).first()
+    return load(entry.data) if entry is not None else None
+
+
+def by_uid(uid):
+    entries = list(JaneusMirrorEntry.objects.filter(uid=str(uid).lower())[:2])
+    return load(entries[0].data) if len(entries) == 1 else None
+
+
+def by_email(email):
+    return [load(data) for data in JaneusMirrorEntry.objects.filter(mail=str(email).lower()).values_list('data', flat=True)]
+
+
+def groups_of_dn(dn):
+    memberships = JaneusMirrorMembership.objects.filter(member=dn_key(dn))
+    return [cn.encode('utf-8') for cn in memberships.values_list('group__cn', flat=True)]
+
+
+def members_of_group(group):
+    members = JaneusMirrorMembership.objects.filter(group__dn=dn_key("cn={},{}".format(group, GROUPS)))
+    entries = JaneusMirrorEntry.objects.filter(dn__in=members.values('member'))
+    return [load(data) for data in entries.values_list('data', flat=True)]
+
+
+def last_modified(model):
+    """Returns the newest modifyTimestamp in the mirror, or None"""
+    values = model.objects.exclude(modified='').order_by('-modified').values_list('modified', flat=True)[:1]
+    return values[0] if values else None
+
+
+def sync_entries(entries, full=False):
+    """Stores the LDAP entries (dn, attrs), returns (created, updated, deleted).
+    With full, entries contains all users and other stored users are deleted.
+    """
+    created = updated = 0
+    seen = set()
+    chunk = []
+    for entry in entries:
+        seen.add(dn_key(entry[0]))
+        chunk.append(entry)
+        if len(chunk) >= BATCH_SIZE:
+            new, changed = store(JaneusMirrorEntry, chunk, entry_fields)
+            created, updated, chunk = created + new, updated + changed, []
+    new, changed = store(JaneusMirrorEntry, chunk, entry_fields)
+    created, updated = created + new, updated + changed
+
+    deleted = 0
+    if full:
+        stale = [pk for pk, dn in JaneusMirrorEntry.objects.values_list('pk', 'dn') if dn not in seen]
+        deleted = delete(JaneusMirrorEntry, stale)
+    return created, updated, deleted
+
+
+def group_fields(dn, attrs):
+    return {
+        'cn': _text(attrs['cn'][0]),
+        'modified': _text(attrs.get('modifyTimestamp', [b''])[0]),
+    }
+
+
+def sync_groups(entries, full=False):
+    """Stores the LDAP groups (dn, attrs) and their members, returns (created, updated, deleted).
+    With full, entries contains all groups and other stored groups are deleted.
+    """
+    groups = list(entries)
+    created, updated = store(JaneusMirrorGroup, groups, group_fields)
+
+    pks = dict(JaneusMirrorGroup.objects.filter(dn__in=[dn_key(dn) for dn, attrs in groups]).values_list('dn', 'pk'))
+    JaneusMirrorMembership.objects.filter(group__in=list(pks.values())).delete()
+    JaneusMirrorMembership.objects.bulk_create([
+        JaneusMirrorMembership(group_id=pks[dn_key(dn)], member=member)
+        for dn, attrs in groups for member in set(dn_key(m) for m in attrs.get('member', []) if m)], batch_size=BATCH_SIZE)
+
+    deleted = 0
+    if full:
+        seen = set(pks)
+        stale = [pk for pk, dn in JaneusMirrorGroup.objects.values_list('pk', 'dn') if dn not in seen]
+        deleted = delete(JaneusMirrorGroup, stale)
+    return created, updated, deleted
+
+
+def store(model, entries, fields):
+    """Creates or updates the rows of model for entries (dn, attrs), returns (created, updated)"""
+    if not entries:
+        return 0, 0
+    values = dict((dn_key(dn), fields(dn, attrs)) for dn, attrs in entries)
+    existing = dict((obj.dn, obj) for obj in model.objects.filter(dn__in=list(values)))
+    new = [model(dn=dn, **kwargs) for dn, kwargs in values.items() if dn not in existing]
+    model.objects.bulk_create(new, batch_size=BATCH_SIZE)
+    updated = 0
+    for dn, obj in existing.items():
+        changed = dict((name, value) for name, value in values[dn].items() if getattr(obj, name) != value)
+        if changed:
+            model.objects.filter(pk=obj.pk).update(**changed)
+            updated += 1
+    return len(new), updated
+
+
+def delete(model, pks):
+    for i in range(0, len(pks), BATCH_SIZE):
+        model.objects.filter(pk__in=pks[i:i + BATCH_SIZE]).delete()
+    return len(pks)
+
+
+def filter_since(filterstr, since):
+    """Limits filterstr to entries modified at or after the LDAP timestamp since"""
+    if since is None:
+        return filterstr
+    return '(&{}{})'.format(filterstr, filter_format('(modifyTimestamp>=%s)', (since,)))
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
+import json
+from datetime import timedelta
 from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import Group, Permission
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils import timezone
+from django.utils.encoding import force_text, python_2_unicode_compatible
 
 
 @python_2_unicode_compatible
@@ -20,6 +23,54 @@ class JaneusRole(models.Model):
 class JaneusUser(models.Model):
     uid = models.CharField(max_length=250, unique=True)
     user = models.OneToOneField(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+    ldap_groups = models.TextField(blank=True, default='')
+    ldap_groups_updated = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return "Janeus User '{0}'".format(self.uid)
+
+    def get_ldap_groups(self):
+        """Returns the snapshot of LDAP groups, or None if there is no snapshot"""
+        if self.ldap_groups_updated is None:
+            return None
+        return json.loads(self.ldap_groups)
+
+    def set_ldap_groups(self, groups):
+        self.ldap_groups = json.dumps([force_text(g) for g in groups])
+        self.ldap_groups_updated = timezone.now()
+
+    def ldap_groups_stale(self):
+        if self.ldap_groups_updated is None:
+            return True
+        refresh = getattr(settings, 'JANEUS_GROUPS_REFRESH', 300)
+        return self.ldap_groups_updated + timedelta(seconds=refresh) < timezone.now()
+
+
+@python_2_unicode_compatible
+class JaneusMirrorEntry(models.Model):
+    """Copy of a user entry in LDAP, see JANEUS_MIRROR and the janeus_sync command"""
+    dn = models.CharField(max_length=250, unique=True)  # lower case
+    uid = models.CharField(max_length=250, db_index=True, blank=True)  # lower case
+    lidnummer = models.IntegerField(null=True, db_index=True)
+    mail = models.CharField(max_length=254, db_index=True, blank=True)  # lower case
+    data = models.TextField()  # JSON with dn and attrs as returned by LDAP
+    modified = models.CharField(max_length=32, blank=True)  # modifyTimestamp
+
+    def __str__(self):
+        return "Janeus Mirror Entry '{0}'".format(self.dn)
+
+
+@python_2_unicode_compatible
+class JaneusMirrorGroup(models.Model):
+    """Copy of a group in LDAP, see JANEUS_MIRROR and the janeus_sync command"""
+    dn = models.CharField(max_length=250, unique=True)  # lower case
+    cn = models.CharField(max_length=250, db_index=True)
+    modified = models.CharField(max_length=32, blank=True)  # modifyTimestamp
+
+    def __str__(self):
+        return "Janeus Mirror Group '{0}'".format(self.cn)
+
+
+class JaneusMirrorMembership(models.Model):
+    group = models.ForeignKey(JaneusMirrorGroup, on_delete=models.CASCADE, related_name='members')
+    member = models.CharField(max_length=250, db_index=True)  # lower case dn
@@ -0,0 +1,45 @@
+"""Panel for django-debug-toolbar that shows the LDAP operations of a request.
+
+Add 'janeus.panels.JaneusPanel' to DEBUG_TOOLBAR_PANELS.
+"""
+
+from django.utils.html import format_html, format_html_join
+from debug_toolbar.panels import Panel
+from janeus import tracing
+
+
+class JaneusPanel(Panel):
+    title = 'Janeus'
+
+    def process_request(self, request):
+        with tracing.collect() as spans:
+            self.spans = spans
+            return super(JaneusPanel, self).process_request(request)
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        if not stats:
+            return ''
+        return '{} LDAP operations in {:.1f}ms'.format(stats['count'], stats['total'])
+
+    def generate_stats(self, request, response):
+        spans = [span.as_dict() for span in getattr(self, 'spans', [])]
+        # searches and binds; the authentication phases contain these, and the searches contain pool_wait and connect
+        ldap = [span for span in spans if span['server'] is not None and span['operation'] not in ('pool_wait', 'connect')]
+        self.record_stats({
+            'spans': spans,
+            'count': len(ldap),
+            'total': 1000 * sum(span['duration'] for span in ldap),
+        })
+
+    @property
+    def content(self):
+        stats = self.get_stats()
+        rows = format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>', (
+            (span['operation'], '{:.1f}'.format(1000 * span['duration']), span['server'] or '', span['base'] or '',
+             span['filter'] or '', '' if span['count'] is None else span['count'], span['error'] or '')
+            for span in stats.get('spans', [])))
+        return format_html(
+            '<table><thead><tr><th>Operation</th><th>Time (ms)</th><th>Server</th><th>Base</th>'
+            '<th>Filter</th><th>Results</th><th>Error</th></tr></thead><tbody>{}</tbody></table>', rows)
@@ -0,0 +1,61 @@
+"""Statistics of the LDAP pools of all worker processes.
+
+Every process stores the statistics of its pools in the Django cache named by
+JANEUS_POOL_STATS_CACHE, at most once every JANEUS_POOL_STATS_INTERVAL seconds.
+The janeus_poolstats management command shows them.
+"""
+
+import os
+import socket
+import time
+from django.conf import settings
+from django.core.cache import caches
+
+INDEX_KEY = 'janeus:poolstats'
+
+_last_published = [0.0]
+
+
+def local_stats():
+    # through Janeus, so the pools are created with the settings if this is their first use
+    from janeus import Janeus
+    return {
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'time': time.time(),
+        'pools': Janeus().pool_stats(),
+    }
+
+
+def publish(force=False):
+    """Stores the statistics of this process in the cache, if enabled and due"""
+    alias = getattr(settings, 'JANEUS_POOL_STATS_CACHE', None)
+    if alias is None:
+        return
+    interval = getattr(settings, 'JANEUS_POOL_STATS_INTERVAL', 60)
+    now = time.time()
+    if not force and now - _last_published[0] < interval:
+        return
+    _last_published[0] = now
+
+    cache = caches[alias]
+    key = '{}:{}:{}'.format(INDEX_KEY, socket.gethostname(), os.getpid())
+    cache.set(key, local_stats(), interval * 3)
+    index = cache.get(INDEX_KEY) or []
+    if key not in index:
+        index.append(key)
+        cache.set(INDEX_KEY, index, None)
+
+
+def collect():
+    """Returns the statistics of all processes that published recently"""
+    alias = getattr(settings, 'JANEUS_POOL_STATS_CACHE', None)
+    if alias is None:
+        return []
+    cache = caches[alias]
+    index = cache.get(INDEX_KEY) or []
+    found = cache.get_many(index)
+    if len(found) != len(index):
+        # forget processes that stopped publishing
+        cache.set(INDEX_KEY, [key for key in index if key in found], None)
+    return [found[key] for key in index if key in found]
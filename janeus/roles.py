@@ -0,0 +1,126 @@
+"""Compiled table of the Janeus roles with their sites and permissions.
+
+The table is built with a few queries and stored in the Django cache named by
+JANEUS_ROLE_CACHE, for at most JANEUS_ROLE_CACHE_TTL seconds. When a JaneusRole,
+Group, Permission or Site changes, a new version is stored in the cache after
+the transaction commits, and tables of older versions are not used again. So
+permission checks do not need the database. With several processes the cache
+must be shared, e.g. memcached or redis; with a per-process cache the other
+processes only notice a change after the TTL.
+"""
+
+import uuid
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sites.models import Site
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils.encoding import force_text
+from janeus.models import JaneusRole
+
+CACHE_KEY = 'janeus:roles'
+VERSION_KEY = 'janeus:roles:version'
+
+
+def _cache():
+    return caches[getattr(settings, 'JANEUS_ROLE_CACHE', 'default')]
+
+
+def build():
+    """Returns a dict role -> list of (pk, site ids, permissions, group permissions) of the JaneusRole objects"""
+    sites = {}
+    for pk, site in JaneusRole.sites.through.objects.values_list('janeusrole_id', 'site_id'):
+        sites.setdefault(pk, set()).add(site)
+
+    perms = {}
+    rows = JaneusRole.permissions.through.objects.values_list(
+        'janeusrole_id', 'permission__content_type__app_label', 'permission__codename')
+    for pk, ct, name in rows:
+        perms.setdefault(pk, set()).add("%s.%s" % (ct, name))
+
+    gperms = {}
+    rows = JaneusRole.groups.through.objects.values_list(
+        'janeusrole_id', 'group__permissions__content_type__app_label', 'group__permissions__codename')
+    for pk, ct, name in rows:
+        if name is not None:
+            gperms.setdefault(pk, set()).add("%s.%s" % (ct, name))
+
+    table = {}
+    for pk, role in JaneusRole.objects.values_list('pk', 'role'):
+        table.setdefault(role, []).append((
+            pk,
+            frozenset(sites.get(pk, ())),
+            frozenset(perms.get(pk, ())),
+            frozenset(gperms.get(pk, ())),
+        ))
+    return table
+
+
+def role_table():
+    cache = _cache()
+    found = cache.get_many([CACHE_KEY, VERSION_KEY])
+    version = found.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    entry = found.get(CACHE_KEY)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    # the version is read before building, so a table built while a change is committed is not used
+    table = build()
+    cache.set(CACHE_KEY, (version, table), getattr(settings, 'JANEUS_ROLE_CACHE_TTL', 300))
+    return table
+
+
+def _new_version():
+    _cache().set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def invalidate(**kwargs):
+    # after the commit, otherwise a table built from the old data in the meantime stays in the cache
+    transaction.on_commit(_new_version, using=kwargs.get('using'))
+
+
+def permissions(groups, site):
+    """Returns (permissions, group permissions) of the roles of groups on site, or on all sites if site is None"""
+    table = role_table()
+    perms = set()
+    gperms = set()
+    for group in groups:
+        for pk, sites, role_perms, role_gperms in table.get(force_text(group), ()):
+            if site is None or not sites or site in sites:
+                perms.update(role_perms)
+                gperms.update(role_gperms)
+    return perms, gperms
+
+
+def resolve(groups, site):
+    """Returns (role pks, site ids, current role pks) of the roles of groups.
+    Site ids is None if the roles give access to all sites.
+    The current role pks are the roles that apply to site, or all roles if site is None.
+    """
+    table = role_table()
+    pks = []
+    sites = set()
+    all_sites = False
+    current = []
+    for group in set(force_text(g) for g in groups):
+        for pk, role_sites, role_perms, role_gperms in table.get(group, ()):
+            pks.append(pk)
+            if role_sites:
+                sites.update(role_sites)
+            else:
+                all_sites = True
+            if site is None or not role_sites or site in role_sites:
+                current.append(pk)
+    return pks, None if all_sites else sites, current
+
+
+def connect_signals():
+    for model in (JaneusRole, Group, Permission, Site):
+        post_save.connect(invalidate, sender=model, dispatch_uid='janeus_roles_save_{}'.format(model.__name__))
+        post_delete.connect(invalidate, sender=model, dispatch_uid='janeus_roles_delete_{}'.format(model.__name__))
+    for through in (JaneusRole.groups.through, JaneusRole.permissions.through, JaneusRole.sites.through,
+                    Group.permissions.through):
+        m2m_changed.connect(invalidate, sender=through, dispatch_uid='janeus_roles_m2m_{}'.format(through.__name__))
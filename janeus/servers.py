@@ -0,0 +1,94 @@
+"""Routing of LDAP operations over several servers.
+
+JANEUS_SERVER is either one URI, a list of URIs of which the first is the
+primary and the others are read replicas, or a dict with 'primary' and
+'replicas'. Searches go to the healthy server with the lowest recent latency,
+binds go to the primary. A server that fails JANEUS_BREAKER_THRESHOLD times in
+a row is skipped for JANEUS_BREAKER_COOLDOWN seconds (circuit breaker).
+"""
+
+import time
+from threading import Lock
+from django.conf import settings
+
+# weight of a new latency measurement in the moving average
+EWMA_WEIGHT = 0.2
+
+
+def configured_servers():
+    """Returns (primary, replicas) from JANEUS_SERVER"""
+    servers = settings.JANEUS_SERVER
+    if isinstance(servers, dict):
+        return servers['primary'], list(servers.get('replicas', []))
+    if isinstance(servers, (list, tuple)):
+        return servers[0], list(servers[1:])
+    return servers, []
+
+
+class _Server(object):
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class ServerRouter(object):
+    __shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if 'lock' not in self.__dict__:
+            self.lock = Lock()
+
+        if 'servers' not in self.__dict__:
+            self.servers = {}
+
+    def _server(self, uri):
+        if uri not in self.servers:
+            self.servers[uri] = _Server()
+        return self.servers[uri]
+
+    def primary(self):
+        return configured_servers()[0]
+
+    def read_servers(self):
+        """Returns the servers to try for a search, best first"""
+        primary, replicas = configured_servers()
+        now = time.time()
+        with self.lock:
+            closed = []
+            opened = []
+            for uri in replicas + [primary]:
+                server = self._server(uri)
+                if server.open_until > now:
+                    opened.append((server.open_until, uri))
+                else:
+                    # servers without measurements first, so they get measured
+                    closed.append((server.latency or 0.0, uri == primary, uri))
+        if closed:
+            return [uri for latency, is_primary, uri in sorted(closed)]
+        # all circuits are open, try the one that will close first
+        return [uri for until, uri in sorted(opened)]
+
+    def record(self, uri, duration=None, failed=False):
+        """Records a successful operation that took duration seconds, or a failed operation"""
+        with self.lock:
+            server = self._server(uri)
+            if failed:
+                server.failures += 1
+                if server.failures >= getattr(settings, 'JANEUS_BREAKER_THRESHOLD', 3):
+                    server.open_until = time.time() + getattr(settings, 'JANEUS_BREAKER_COOLDOWN', 30)
+            else:
+                server.failures = 0
+                server.open_until = 0.0
+                if duration is not None:
+                    if server.latency is None:
+                        server.latency = duration
+                    else:
+                        server.latency += EWMA_WEIGHT * (duration - server.latency)
+
+    def stats(self):
+        with self.lock:
+            return dict((uri, {'latency': s.latency, 'failures': s.failures, 'open': s.open_until > time.time()})
+                        for uri, s in self.servers.items())
@@ -0,0 +1,61 @@
+"""Cached resolution of the current site.
+
+The site id per host name and the set of all site ids are kept in process
+memory for JANEUS_SITE_CACHE_TTL seconds. Saving or deleting a Site clears the
+cache of the current process; other processes notice after the TTL.
+"""
+
+import time
+from threading import Lock
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_delete, post_save
+
+_lock = Lock()
+# key -> (expires, value), the key is a host name or ALL
+_entries = {}
+ALL = object()
+
+
+def _ttl():
+    return getattr(settings, 'JANEUS_SITE_CACHE_TTL', 300)
+
+
+def _cached(key, fetch):
+    with _lock:
+        entry = _entries.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    value = fetch()
+    with _lock:
+        _entries[key] = time.time() + _ttl(), value
+    return value
+
+
+def site_id_for_request(request):
+    """Returns the id of the Site of request, like get_current_site, or None"""
+    from django.contrib.sites.shortcuts import get_current_site
+
+    def fetch():
+        site = get_current_site(request)
+        return site.id if isinstance(site, Site) else None
+
+    if getattr(settings, 'SITE_ID', None) is not None or request is None:
+        # get_current_site does not look at the request
+        return _cached(None, fetch)
+    return _cached(request.get_host().lower(), fetch)
+
+
+def all_site_ids():
+    """Returns a frozenset with the ids of all sites"""
+    return _cached(ALL, lambda: frozenset(Site.objects.values_list('pk', flat=True)))
+
+
+def invalidate(**kwargs):
+    with _lock:
+        _entries.clear()
+
+
+def connect_signals():
+    post_save.connect(invalidate, sender=Site, dispatch_uid='janeus_sites_save')
+    post_delete.connect(invalidate, sender=Site, dispatch_uid='janeus_sites_delete')
@@ -0,0 +1,102 @@
+"""Throttling of failed logins, so that bursts of bad passwords do not reach LDAP.
+
+Failures are counted per username and per client IP address in a sliding
+window of JANEUS_THROTTLE_WINDOW seconds, stored in the Django cache named by
+JANEUS_THROTTLE_CACHE. Usernames that do not exist in LDAP are remembered for
+JANEUS_UNKNOWN_UID_TTL seconds.
+"""
+
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from janeus.utils import current_request
+
+# number of buckets in a window
+BUCKETS = 10
+
+
+def enabled():
+    return getattr(settings, 'JANEUS_THROTTLE', False)
+
+
+def _cache():
+    return caches[getattr(settings, 'JANEUS_THROTTLE_CACHE', 'default')]
+
+
+def _key(*parts):
+    value = ':'.join(str(part) for part in parts)
+    return 'janeus:throttle:' + hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def client_ip(request=None):
+    """Returns the IP address of request (default the current request), or None.
+
+    The address is taken from the META key JANEUS_THROTTLE_IP_HEADER, e.g.
+    'HTTP_X_FORWARDED_FOR' behind a proxy. If that holds a list of addresses,
+    the last one is used, which is the one added by the nearest proxy.
+    """
+    if request is None:
+        request = current_request()
+    if request is None:
+        return None
+    value = request.META.get(getattr(settings, 'JANEUS_THROTTLE_IP_HEADER', 'REMOTE_ADDR'))
+    if not value:
+        return None
+    return value.split(',')[-1].strip() or None
+
+
+def _subjects(username, request):
+    """Returns the (kind, value, limit) that are counted for a login of username"""
+    subjects = [('user', username.lower(), getattr(settings, 'JANEUS_THROTTLE_USER_LIMIT', 10))]
+    limit = getattr(settings, 'JANEUS_THROTTLE_IP_LIMIT', 100)
+    ip = client_ip(request) if limit is not None else None
+    if ip is not None:
+        subjects.append(('ip', ip, limit))
+    return subjects
+
+
+def _buckets(kind, value):
+    """Returns the keys of the buckets of the current window, the current bucket last"""
+    window = getattr(settings, 'JANEUS_THROTTLE_WINDOW', 300)
+    current = int(time.time() * BUCKETS // window)
+    return [_key(kind, value, bucket) for bucket in range(current - BUCKETS + 1, current + 1)], window
+
+
+def is_throttled(username, request=None):
+    """True if there were too many failed logins for username or the client of request (default the current request)"""
+    if not enabled():
+        return False
+    cache = _cache()
+    for kind, value, limit in _subjects(username, request):
+        keys, window = _buckets(kind, value)
+        if sum(cache.get_many(keys).values()) >= limit:
+            return True
+    return False
+
+
+def record_failure(username, request=None):
+    if not enabled():
+        return
+    cache = _cache()
+    for kind, value, limit in _subjects(username, request):
+        keys, window = _buckets(kind, value)
+        key = keys[-1]
+        if not cache.add(key, 1, window):
+            try:
+                cache.incr(key)
+            except ValueError:
+                # expired in the meantime
+                cache.set(key, 1, window)
+
+
+def is_unknown(username):
+    """True if username was recently not found in LDAP"""
+    if not enabled():
+        return False
+    return _cache().get(_key('unknown', username.lower())) is not None
+
+
+def record_unknown(username):
+    if enabled():
+        _cache().set(_key('unknown', username.lower()), True, getattr(settings, 'JANEUS_UNKNOWN_UID_TTL', 60))
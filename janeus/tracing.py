@@ -0,0 +1,102 @@
+"""Timed spans of LDAP operations and authentication phases.
+
+Every span is passed to the exporter in JANEUS_TRACE_EXPORTER (a function or
+its dotted path), spans that take at least JANEUS_SLOW_THRESHOLD seconds are
+logged to the janeus.slow logger, and collect() gathers the spans of the
+current thread, e.g. for the debug toolbar panel in janeus.panels.
+"""
+
+import logging
+import re
+import time
+from contextlib import contextmanager
+from threading import local
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+slow_logger = logging.getLogger('janeus.slow')
+
+_local = local()
+
+
+class Span(object):
+    __slots__ = ('operation', 'server', 'base', 'filter', 'count', 'start', 'duration', 'error')
+
+    def __init__(self, operation, server=None, base=None, filterstr=None):
+        self.operation = operation
+        self.server = server
+        self.base = base
+        self.filter = filter_template(filterstr)
+        self.count = None
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __str__(self):
+        return '{} {:.1f}ms server={} base={} filter={} count={}{}'.format(
+            self.operation, 1000 * self.duration, self.server, self.base, self.filter, self.count,
+            ' error={}'.format(self.error) if self.error else '')
+
+
+def filter_template(filterstr):
+    """Returns filterstr with the values replaced by ?, e.g. (&(objectClass=?)(uid=?))"""
+    if filterstr is None:
+        return None
+    return re.sub(r'(~=|>=|<=|=)([^()]*)', lambda m: m.group(1) + ('*' if m.group(2) == '*' else '?'), filterstr)
+
+
+def _exporter():
+    exporter = getattr(settings, 'JANEUS_TRACE_EXPORTER', None)
+    return import_string(exporter) if isinstance(exporter, str) else exporter
+
+
+def finish(span):
+    """Sends a finished span to the collectors, the slow log and the exporter"""
+    for spans in getattr(_local, 'collectors', ()):
+        spans.append(span)
+
+    threshold = getattr(settings, 'JANEUS_SLOW_THRESHOLD', None)
+    if threshold is not None and span.duration >= threshold:
+        slow_logger.warning('Slow Janeus operation: {}'.format(span))
+
+    exporter = _exporter()
+    if exporter is not None:
+        exporter(span)
+
+
+@contextmanager
+def span(operation, server=None, base=None, filterstr=None):
+    """Times the block as a span; the block can set the count of the yielded span"""
+    s = Span(operation, server, base, filterstr)
+    try:
+        yield s
+    except Exception as e:
+        s.error = e.__class__.__name__
+        raise
+    finally:
+        s.duration = time.time() - s.start
+        finish(s)
+
+
+def record(operation, duration, server=None, base=None):
+    """Adds a span that has already finished, e.g. the time spent waiting for a pooled connection"""
+    s = Span(operation, server, base)
+    s.start -= duration
+    s.duration = duration
+    finish(s)
+
+
+@contextmanager
+def collect():
+    """Yields a list that receives the spans of the current thread until the block ends"""
+    spans = []
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    _local.collectors.append(spans)
+    try:
+        yield spans
+    finally:
+        _local.collectors = [c for c in _local.collectors if c is not spans]
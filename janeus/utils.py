@@ -8,6 +8,11 @@ def current_request():
     return getattr(_thread_local, "request", None)
 
 
+def request_memo():
+    """Returns the dict in which Janeus keeps lookups during the current request, or None"""
+    return getattr(current_request(), "_janeus_memo", None)
+
+
 class CurrentRequestMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
@@ -16,9 +21,11 @@ class CurrentRequestMiddleware(object):
         """ New MIDDLEWARE behavior.
         """
         _thread_local.request = request
+        request._janeus_memo = {}
         return self.get_response(request)
 
     def process_request(self, request):
         """ Old MIDDLEWARE_CLASSES behavior.
         """
         _thread_local.request = request
+        request._janeus_memo = {}